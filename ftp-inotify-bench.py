@@ -0,0 +1,364 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""ftp-inotify.py的性能测试
+
+在临时目录中运行守护进程的监视和上传流程（run()、EventHandler、上传队列），
+上传到本机子进程中的FTP服务器（pyftpdlib），对每种负载输出：
+每秒处理的事件数、上传速度、从事件到服务器执行完成的延迟（p50/p99）、CPU使用率。
+负载在子进程中生成，CPU使用率只包括守护进程的线程。
+
+较早版本的守护进程脚本（没有运行指标）也可以测试，这时上传的数据量按服务器上的文件大小估算，
+不输出任务数和延迟；脚本中没有的配置项会被跳过。
+
+需要安装pyftpdlib：shell> sudo pip install pyftpdlib
+
+使用方法：
+shell> python ftp-inotify-bench.py
+shell> python ftp-inotify-bench.py -w small,rename -s 0.5 -o COALESCE_WINDOW=0 -j bench.json
+shell> python ftp-inotify-bench.py -d old/ftp-inotify.py -o FILE_EXTENSIONS=.dat
+"""
+
+import os, sys, re, imp, time, json, shutil, tempfile, threading, logging, getopt, ast, random, ftplib
+import multiprocessing
+
+# 负载的默认规模，使用-s参数按比例放大或缩小
+SMALL_FILES = 2000
+HUGE_FILES = 3
+HUGE_FILE_SIZE = 64 * 1024 * 1024
+DEEP_TREES = 50
+DEEP_DEPTH = 10
+RENAME_FILES = 500
+RENAME_TIMES = 3
+CHURN_FILES = 1000
+
+# 等待同步完成的最长时间（秒）
+SETTLE_TIMEOUT = 600
+
+# 守护进程处理的inotify事件数
+EVENTS = [0]
+
+def serve(remote, ports):
+    """在子进程中运行FTP服务器，避免服务器占用的CPU计入测试结果"""
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    from pyftpdlib.log import config_logging
+
+    config_logging(level=logging.WARNING)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('bench', 'bench', remote, perm='elradfmwMT')
+    handler = FTPHandler
+    handler.authorizer = authorizer
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    ports.put(server.socket.getsockname()[1])
+    server.serve_forever()
+
+def load(path, overrides):
+    """替换配置项后加载守护进程脚本，不启动守护进程，脚本中没有的配置项跳过"""
+    source = open(path).read()
+    for key, value in sorted(overrides.items()):
+        source, count = re.subn(r'(?m)^%s\s*=.*$' % key, '%s = %r' % (key, value), source, count=1)
+        if not count:
+            print >>sys.stderr, 'Skipped unknown setting: %s.' % (key)
+
+    module = imp.new_module('ftp_inotify')
+    module.__file__ = path
+    # 模块对象被回收时全局变量会被清空，守护进程的线程仍然需要使用
+    sys.modules[module.__name__] = module
+    exec compile(source, path, 'exec') in module.__dict__
+    return module
+
+def write(path, size, block=None):
+    with open(path, 'wb') as fp:
+        if block is None:
+            fp.write(os.urandom(size))
+            return
+        while size > 0:
+            fp.write(block[:size])
+            size -= len(block)
+
+def small(root, scale):
+    """大量的小文件"""
+    for i in range(int(SMALL_FILES * scale)):
+        dirname = os.path.join(root, 'd%02d' % (i % 20))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        write(os.path.join(dirname, 'f%05d.dat' % i), random.randint(1024, 8192))
+
+def huge(root, scale):
+    """少量的大文件"""
+    block = os.urandom(1024 * 1024)
+    for i in range(HUGE_FILES):
+        write(os.path.join(root, 'f%d.dat' % i), int(HUGE_FILE_SIZE * scale), block)
+
+def deep(root, scale):
+    """mkdir -p创建的多级目录，每级目录下一个文件"""
+    for i in range(int(DEEP_TREES * scale)):
+        path = os.path.join(root, *['t%03d-%d' % (i, level) for level in range(DEEP_DEPTH)])
+        os.makedirs(path)
+        while path != root:
+            write(os.path.join(path, 'f.dat'), 1024)
+            path = os.path.dirname(path)
+
+def rename_prepare(root, scale):
+    for i in range(int(RENAME_FILES * scale)):
+        write(os.path.join(root, 'f%05d.dat' % i), 2048)
+
+def rename(root, scale):
+    """已同步的文件多次重命名"""
+    for i in range(int(RENAME_FILES * scale)):
+        path = os.path.join(root, 'f%05d.dat' % i)
+        for n in range(RENAME_TIMES):
+            target = os.path.join(root, 'f%05d-%d.dat' % (i, n))
+            os.rename(path, target)
+            path = target
+
+def churn(root, scale):
+    """创建后马上删除的文件，保留其中的一半"""
+    for i in range(int(CHURN_FILES * scale)):
+        path = os.path.join(root, 'f%05d.dat' % i)
+        write(path, 1024)
+        if i % 2:
+            os.remove(path)
+
+# 负载名称：(准备函数，不计入测试结果；负载函数)
+WORKLOADS = [
+    ('small', (None, small)),
+    ('huge', (None, huge)),
+    ('deep', (None, deep)),
+    ('rename', (rename_prepare, rename)),
+    ('churn', (None, churn)),
+]
+
+def tree(root):
+    """目录树中所有的路径和文件大小"""
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames:
+            result[os.path.relpath(os.path.join(dirpath, name), root) + '/'] = None
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            result[os.path.relpath(path, root)] = os.path.getsize(path)
+    return result
+
+def counter(daemon, name):
+    """守护进程的计数器，没有运行指标时返回None"""
+    metrics = getattr(daemon, 'Metrics', None)
+    if metrics is None:
+        return None
+    return sum(value for (key, labels), value in metrics.counters.items() if key == name)
+
+def idle(daemon):
+    """所有的变化都已经执行完成，较早的版本在事件处理线程中直接上传，没有这些队列"""
+    coalescer = getattr(daemon, 'Coalescer', None)
+    if coalescer is not None and coalescer.pending:
+        return False
+    spool = getattr(daemon, 'RetrySpool', None)
+    if spool is not None and spool.count:
+        return False
+    rescanner = getattr(daemon, 'Rescanner', None)
+    if rescanner is not None and (rescanner.pending or getattr(rescanner, 'trees', None)):
+        return False
+    transfer = getattr(daemon, 'Transfer', None)
+    for target in transfer.targets if transfer is not None else []:
+        if target.queue.qsize() or target.queue.running:
+            return False
+    return True
+
+def settle(daemon):
+    """等待同步完成，返回完成的时间"""
+    deadline = time.time() + SETTLE_TIMEOUT
+    events = None
+    finished = None
+    while time.time() < deadline:
+        current = EVENTS[0]
+        if idle(daemon) and current == events:
+            # 连续一段时间没有新的事件
+            if time.time() - finished >= 0.5:
+                return finished
+        else:
+            finished = time.time()
+        events = current
+        time.sleep(0.05)
+    raise RuntimeError('Waiting for sync timed out.')
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[int(round(p * (len(samples) - 1)))]
+
+def measure(daemon, name, workload, watch, remote, scale, latencies):
+    prepare, generate = workload
+    root = os.path.join(watch, name)
+    os.mkdir(root)
+    if prepare is not None:
+        prepare(root, scale)
+    settle(daemon)
+
+    events = EVENTS[0]
+    uploaded = counter(daemon, 'sync_uploaded_bytes_total')
+    del latencies[:]
+    # 只统计本进程（守护进程的线程）的CPU时间，生成负载的子进程和FTP服务器不计入
+    cpu = sum(os.times()[:2])
+    start = time.time()
+
+    worker = multiprocessing.Process(target=generate, args=(root, scale))
+    worker.start()
+    worker.join()
+    if worker.exitcode:
+        raise RuntimeError('Generating workload failed: workload=%s, exitcode=%d.' % (name, worker.exitcode))
+    finished = settle(daemon)
+
+    elapsed = max(finished - start, 0.001)
+    cpu = sum(os.times()[:2]) - cpu
+    events = EVENTS[0] - events
+    local = tree(root)
+    mirror = tree(os.path.join(remote, name))
+    mismatch = len(set(local.items()) ^ set(mirror.items()))
+    if uploaded is None:
+        uploaded = sum(size for size in mirror.values() if size)
+    else:
+        uploaded = counter(daemon, 'sync_uploaded_bytes_total') - uploaded
+
+    return {
+        'workload': name,
+        'events': events,
+        'elapsed': elapsed,
+        'events_per_sec': events / elapsed,
+        'mb': uploaded / 1048576.0,
+        'mb_per_sec': uploaded / 1048576.0 / elapsed,
+        'tasks': len(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'cpu_percent': cpu / elapsed * 100,
+        'mismatch': mismatch,
+    }
+
+def usage():
+    print 'Usage: python %s [-d daemon] [-w workloads] [-s scale] [-o KEY=VALUE] [-j file] [-v]' % (sys.argv[0])
+    print '  -d  path of the daemon script, default: ftp-inotify.py in the same dir'
+    print '  -w  comma separated workloads, default: %s' % (','.join(name for name, _ in WORKLOADS))
+    print '  -s  scale of the workloads, default: 1'
+    print '  -o  override a setting of the daemon, e.g. -o COALESCE_WINDOW=0 -o TRANSFER_POOL_SIZE=8'
+    print '  -j  write the results into a JSON file'
+    print '  -v  output the logs of the daemon'
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'd:w:s:o:j:vh')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ftp-inotify.py')
+    names = [name for name, _ in WORKLOADS]
+    scale = 1.0
+    overrides = {}
+    output = None
+    verbose = False
+    for opt, arg in opts:
+        if opt == '-d':
+            path = arg
+        elif opt == '-w':
+            names = arg.split(',')
+        elif opt == '-s':
+            scale = float(arg)
+        elif opt == '-o':
+            key, _, value = arg.partition('=')
+            try:
+                overrides[key] = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                overrides[key] = value
+        elif opt == '-j':
+            output = arg
+        elif opt == '-v':
+            verbose = True
+        else:
+            usage()
+            sys.exit()
+
+    workloads = dict(WORKLOADS)
+    for name in names:
+        if name not in workloads:
+            print >>sys.stderr, 'Unknown workload: %s.' % (name)
+            sys.exit(2)
+
+    base = tempfile.mkdtemp(prefix='ftp-inotify-bench-')
+    watch = os.path.join(base, 'watch') + '/'
+    remote = os.path.join(base, 'remote')
+    os.mkdir(watch)
+    os.mkdir(remote)
+
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(remote, ports))
+    server.daemon = True
+    server.start()
+    port = ports.get(timeout=10)
+
+    settings = {
+        # 不读取本机的外部配置文件（/etc/ftp-inotify.conf），各次测试的配置相同
+        'CONFIG_FILE': None,
+        'WATCH_PATH': watch, 'LOG_FILE': None, 'INDEX_FILE': os.path.join(base, 'index.db'),
+        'RETRY_DEAD_LETTER_FILE': os.path.join(base, 'dead-letter.log'), 'METRICS_LISTEN': None,
+        'UPLOAD_FTP_HOST': '127.0.0.1', 'UPLOAD_FTP_USER': 'bench', 'UPLOAD_FTP_PASS': 'bench',
+        'FILE_TYPES': '', 'FILE_EXTENSIONS': '',
+    }
+    settings.update(overrides)
+
+    try:
+        daemon = load(path, settings)
+        logging.getLogger().setLevel(logging.INFO if verbose else logging.WARNING)
+
+        # 守护进程只配置了FTP主机名，只在守护进程中使用测试服务器的端口
+        class BenchFTP(ftplib.FTP):
+            pass
+        BenchFTP.port = port
+        daemon.FTP = BenchFTP
+
+        # 统计处理的事件数
+        call = daemon.EventHandler.__call__
+        def count(handler, event):
+            EVENTS[0] += 1
+            return call(handler, event)
+        daemon.EventHandler.__call__ = count
+
+        # 记录每个任务从事件到服务器执行完成的延迟
+        latencies = []
+        if hasattr(daemon, 'Metrics'):
+            observe = daemon.Metrics.observe
+            def record(name, value, **labels):
+                if name == 'sync_lag_seconds':
+                    latencies.append(value)
+                observe(name, value, **labels)
+            daemon.Metrics.observe = staticmethod(record)
+
+        worker = threading.Thread(target=daemon.run, name='daemon')
+        worker.daemon = True
+        worker.start()
+        settle(daemon)
+
+        results = []
+        print '%-8s %8s %10s %9s %9s %7s %9s %9s %6s %9s' % ('workload', 'events', 'events/s', 'MB', 'MB/s', 'tasks', 'p50(ms)', 'p99(ms)', 'cpu%', 'mismatch')
+        for name in names:
+            result = measure(daemon, name, workloads[name], watch, remote, scale, latencies)
+            results.append(result)
+            print '%-8s %8d %10.1f %9.1f %9.2f %7d %9.1f %9.1f %6.1f %9d' % (
+                name, result['events'], result['events_per_sec'], result['mb'], result['mb_per_sec'],
+                result['tasks'], result['p50_ms'], result['p99_ms'], result['cpu_percent'], result['mismatch'])
+            sys.stdout.flush()
+
+        if output:
+            with open(output, 'w') as fp:
+                json.dump({'daemon': os.path.abspath(path), 'scale': scale, 'settings': overrides, 'results': results}, fp, indent=2)
+    finally:
+        # 删除临时目录产生的事件不需要再同步
+        logging.disable(logging.CRITICAL)
+        server.terminate()
+        shutil.rmtree(base, ignore_errors=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+    # 守护进程的线程不会退出，直接结束进程
+    sys.stdout.flush()
+    os._exit(0)
@@ -9,10 +9,6 @@
 =====================================
 已知不支持同步的操作：
 
-shell> mkdir -p dir1/dir11
-不支持使用-p参数一次性创建多级目录，需要拆分成多条命令分别创建目录。
--------
-
 在很短的时间内，创建并删除目录，会导致错误，但不会导致守护程序中断，终端会有类似下面提示：
 [2013-01-23 09:55:31,472 pyinotify ERROR] add_watch: cannot watch /tmp/the-test/dir5 WD=-1, Errno=No such file or directory (ENOENT)
 -------
@@ -24,10 +20,32 @@ shell> mkdir -p dir1/dir11
 import pyinotify
 import os, sys, mimetypes, logging, getopt, traceback, signal
 from logging import handlers
-import re, string
-from ftplib import FTP
+import re, string, time, threading, collections, copy, sqlite3, hashlib, stat, select, errno, fnmatch
+import functools, bisect, heapq, socket, random, json, shutil, BaseHTTPServer, SocketServer
+from cStringIO import StringIO
+from ftplib import FTP, error_perm
 from socket import _GLOBAL_DEFAULT_TIMEOUT
 
+# 遍历目录时优先使用scandir，不需要对每个子项调用stat
+# Python2.7需要安装：shell> sudo pip install scandir
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# 上传时优先使用sendfile，文件内容直接由内核发送到网络
+# Python2.7需要安装：shell> sudo pip install pysendfile
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
 
 ################################################################################
 # 以下内容是守护进程的配置信息，请根据提示进行对应配置
@@ -61,6 +79,19 @@ LOG_FILE = os.path.join('/var/log/', os.path.splitext(os.path.basename(sys.argv[
 #
 WATCH_PATH = '/tmp/the-test/'
 
+#
+# 在同一个进程中监视多个路径，共享同一个inotify实例和上传队列，不需要为每个路径复制一份脚本
+# 每项为一个dict，可用的键：
+# path    : 监视路径（必须），各监视路径之间不能互相包含
+# remote  : 服务器上对应的路径前缀，默认为空（服务器上的登录目录）
+# targets : 同步到的目标服务器（UPLOAD_FTP_TARGETS中的name）的列表，默认为所有的服务器
+# include、exclude、prune、types、extensions、max_size : 过滤规则，默认使用下面的FILTER_****、FILE_TYPES、FILE_EXTENSIONS
+# 例如：[{'path': '/data/www/', 'remote': 'www'},
+#        {'path': '/data/static/', 'remote': 'static', 'targets': ['cdn'], 'extensions': 'css,js,png'}]
+# 为空时只监视WATCH_PATH
+#
+WATCH_ROOTS = []
+
 #
 # 配置上传的FTP账号
 #
@@ -68,6 +99,18 @@ UPLOAD_FTP_HOST = ''
 UPLOAD_FTP_USER = ''
 UPLOAD_FTP_PASS = ''
 
+#
+# 同时同步到多个FTP服务器
+# 每个服务器使用各自的FTP连接和上传队列，较慢的服务器不会拖慢其它服务器的同步，
+# 变化的文件只从磁盘读取一次，然后发送给所有的服务器
+# 每项为一个dict，可用的键：name、transport、host、user、pass、path、pool_size（默认为TRANSFER_POOL_SIZE）、rate_limit（参考TRANSFER_RATE_LIMIT）
+# transport为传输方式：ftp（默认，需要host、user、pass）、local（同步到本地目录path，例如挂载的NFS）
+# 例如：[{'name': 'mirror1', 'host': '192.168.0.10', 'user': 'sync', 'pass': '***'},
+#        {'name': 'nfs', 'transport': 'local', 'path': '/mnt/backup'}]
+# 为空时只同步到上面UPLOAD_FTP_****配置的服务器
+#
+UPLOAD_FTP_TARGETS = []
+
 #
 # 允许同步的文件类型
 # 值为正则表达式
@@ -75,11 +118,280 @@ UPLOAD_FTP_PASS = ''
 FILE_TYPES = 'image,text'
 FILE_EXTENSIONS  = 'jpg,jpeg,png,gif,txt,js,css'
 
+#
+# 路径过滤规则，使用通配符（glob），启动时编译一次，只根据路径名判断，不需要访问磁盘
+# 与.gitignore相同：不包含/的规则匹配任意层级的名称，开头或中间包含/的规则匹配相对于监视路径的路径，
+# 以/结尾的规则只匹配目录（任意层级，用于INCLUDE、EXCLUDE时匹配目录下的文件）
+#
+# FILTER_INCLUDE    : 只同步匹配的文件，为空表示不限制，例如：['*.html', 'static/*']
+# FILTER_EXCLUDE    : 不同步匹配的文件，例如：['*.swp', '*~', '.#*']
+# FILTER_PRUNE_DIRS : 不同步也不监视匹配的目录及其下的所有内容，例如：['.git/', '.svn/', 'node_modules/']
+# FILTER_MAX_SIZE   : 不同步超过该大小（字节）的文件，0表示不限制
+#
+FILTER_INCLUDE = []
+FILTER_EXCLUDE = []
+FILTER_PRUNE_DIRS = []
+FILTER_MAX_SIZE = 0
+
+#
+# 上传队列的最大长度
+# 监视到的变化先放入内存队列，由后台线程负责上传，避免慢速上传阻塞inotify事件的读取
+# 0表示不限制队列长度
+#
+TRANSFER_QUEUE_SIZE = 10000
+
+#
+# 上传队列已满时的处理策略
+# block       : 阻塞事件处理，直到队列有空位，最多等待TRANSFER_QUEUE_TIMEOUT秒（None表示一直等待），超时后丢弃新任务
+#               同步到多个服务器时不等待，与drop_newest相同，较慢的服务器不会阻塞其它服务器
+# drop_oldest : 丢弃队列中最早的任务
+# drop_newest : 丢弃新的任务
+# 丢弃的任务保存到重试队列稍后执行，不能重试时重新扫描所在的目录
+#
+TRANSFER_QUEUE_FULL_POLICY = 'block'
+TRANSFER_QUEUE_TIMEOUT = None
+
+#
+# 同时连接FTP服务器的会话数量（传输线程数量）
+# 同一路径（包括目录和其下的文件）的操作按照事件发生的顺序执行，互不相关的路径并行上传
+#
+TRANSFER_POOL_SIZE = 4
+
+#
+# 上传限速（字节/秒），所有的目标服务器共享，0表示不限速
+# 也可以按时间段限速，例如只在工作时间限速为2MB/s，其它时间不限速：[('09:00', '18:00', 2 * 1024 * 1024)]
+# 每个目标服务器的限速使用UPLOAD_FTP_TARGETS中的rate_limit配置，格式相同
+#
+TRANSFER_RATE_LIMIT = 0
+
+#
+# 上传任务的优先级，按顺序匹配，排在前面的优先级高，没有匹配的文件优先级最低
+# 每项为一个dict，可用的键：name（必须）、max_size（文件大小不超过该值）、extensions（逗号分隔的扩展名）、
+# paths（通配符列表，规则同FILTER_****），配置了多个键时需要全部匹配
+# 传输线程优先执行优先级高的任务，同一路径上的操作仍然按照事件发生的顺序执行
+# 创建目录、删除、重命名等任务耗时很短，总是最先执行
+# 例如：[{'name': 'web', 'extensions': 'html,css,js'}, {'name': 'small', 'max_size': 1024 * 1024}]
+# 为空时按照事件发生的顺序执行
+# 任务在上传队列中等待超过TRANSFER_PRIORITY_MAX_WAIT秒后，不再按优先级，按照加入队列的顺序执行，
+# 避免持续有高优先级的任务时，低优先级的任务一直不能执行，0表示不限制
+#
+TRANSFER_PRIORITY_CLASSES = []
+TRANSFER_PRIORITY_MAX_WAIT = 60
+
+#
+# 合并短时间内的多次变化（秒）
+# 同一路径在COALESCE_WINDOW秒内没有新的变化后才会上传，多次写入只上传一次，
+# 创建后马上删除的文件不会上传，写入后重命名的文件直接上传为新的文件名
+# 0表示关闭合并功能，每次变化都会立即上传
+#
+COALESCE_WINDOW = 1
+
+#
+# 合并的最长等待时间（秒）
+# 持续变化的文件（例如正在写入的日志）最多等待COALESCE_MAX_DELAY秒后上传
+#
+COALESCE_MAX_DELAY = 10
+
+#
+# 同步到多个服务器时，缓存在内存中的文件内容大小（字节）
+# 小于FANOUT_BUFFER_FILE_SIZE的文件读取一次后在内存中共享给所有服务器，
+# 所有缓存的总大小不超过FANOUT_BUFFER_TOTAL_SIZE，超出后直接从磁盘读取
+#
+FANOUT_BUFFER_FILE_SIZE = 16 * 1024 * 1024
+FANOUT_BUFFER_TOTAL_SIZE = 256 * 1024 * 1024
+
+#
+# 启动时加入监视的目录较多时，每加入STARTUP_PROGRESS_INTERVAL个目录输出一次进度
+#
+STARTUP_PROGRESS_INTERVAL = 10000
+
+#
+# 同步状态索引文件（SQLite数据库）
+# 记录每个文件最后一次成功上传时的大小和修改时间，守护进程停止期间发生的变化，
+# 在下次启动时通过与索引比较找出，只上传缺失或有变化的文件
+# 在/var/lib/下，创建和脚本同名的路径，例如：/var/lib/ftp-inotify/index.db
+# 使用None，则不记录同步状态
+#
+INDEX_FILE = os.path.join('/var/lib/', os.path.splitext(os.path.basename(sys.argv[0]))[0], 'index.db')
+
+#
+# 是否在索引中记录文件内容的MD5
+# 开启后，大小相同、只有修改时间变化的文件，比较MD5后再决定是否上传
+#
+INDEX_HASH = False
+
+#
+# 启动时是否与索引比较，上传守护进程停止期间变化的文件
+#
+RECONCILE_ON_START = True
+
+#
+# 启动时，对于索引中有记录、本地已经不存在的文件，是否从服务器上删除
+#
+RECONCILE_DELETE = False
+
+#
+# 内容去重，上传前计算文件内容的MD5，与该目标服务器上次上传的内容相同时跳过上传
+# 例如touch、编辑器或构建工具重新写入了没有变化的内容
+# 需要INDEX_FILE记录上次上传的内容的MD5（开启后相当于同时开启了INDEX_HASH）
+# 计算过的MD5按文件大小和修改时间缓存在内存中，最多缓存DEDUPE_CACHE_SIZE个文件
+# 大小与上次上传时不同的文件上传前不计算MD5，大于DEDUPE_MAX_SIZE字节的文件不去重（0为不限制）
+#
+DEDUPE = True
+DEDUPE_CACHE_SIZE = 100000
+DEDUPE_MAX_SIZE = 64 * 1024 * 1024
+
+#
+# 文件的内容与服务器上已经上传过的另一个文件相同时，使用服务器端复制代替上传
+# FTP服务器需要支持SITE CPFR/CPTO命令（例如ProFTPD的mod_copy），不支持时改为上传
+#
+DEDUPE_COPY = False
+
+#
+# 内核的inotify事件队列溢出（IN_Q_OVERFLOW），或者新目录加入监视失败时，部分变化会丢失，
+# 这时重新扫描受影响的目录树，与索引比较后只上传有变化的文件，并把没有监视的目录加入监视
+# RESCAN_DELAY秒内的多次重新扫描合并为一次
+# RESCAN_DELETE为是否从服务器上删除索引中有记录、本地已经不存在的文件，无法读取的目录下的文件不会删除
+#
+RESCAN_DELAY = 1
+RESCAN_DELETE = False
+
+#
+# 移动（重命名）事件的配对超时时间（秒）
+# 移出事件（IN_MOVED_FROM）在该时间内没有对应的移入事件（IN_MOVED_TO）时，
+# 认为文件或目录被移到了监视路径以外，从服务器上删除
+#
+MOVE_PAIR_TIMEOUT = 0.5
+
+#
+# 缓存FTP服务器上的目录内容，跳过已知不需要执行的MKD、DELE、RMD命令，缓存中没有时直接执行命令
+# REMOTE_CACHE_SIZE为最多缓存的目录数量，0表示不使用缓存
+# REMOTE_CACHE_TTL为缓存的有效时间（秒），超时后丢弃
+#
+REMOTE_CACHE_SIZE = 10000
+REMOTE_CACHE_TTL = 600
+
+#
+# 断点续传
+# 不小于RESUME_MIN_SIZE字节的二进制文件，上传中断后从已经发送的位置继续上传（不超过服务器上已有的大小），
+# 上传进度记录在索引文件中，守护进程重启后也可以继续上传
+# RESUME_COMMAND为续传使用的命令：REST（REST + STOR）或者APPE
+# RESUME_RETRIES为上传中断后最多续传的次数
+# RESUME_MIN_SIZE为0表示关闭断点续传
+#
+RESUME_MIN_SIZE = 16 * 1024 * 1024
+RESUME_COMMAND = 'REST'
+RESUME_RETRIES = 3
+
+#
+# 先上传为临时文件，上传完成后再重命名（RNFR/RNTO）为正式的文件名
+# 避免服务器上的用户读取到还没有上传完的文件
+# ATOMIC_TEMP_NAME为临时文件名，%s会被替换为正式的文件名，临时文件和正式文件在同一个目录下
+#
+ATOMIC_UPLOAD = False
+ATOMIC_TEMP_NAME = '.%s.sync-tmp'
+
+#
+# 上传模式
+# auto   : 读取文件开头的内容判断是否是文本文件，文本文件使用ASCII模式上传（转换换行符）
+# binary : 所有文件都使用二进制模式上传，不需要读取文件内容进行判断，速度更快
+#
+TRANSFER_MODE = 'auto'
+
+#
+# 二进制模式上传时，每次发送的数据块大小（字节）
+#
+TRANSFER_BLOCK_SIZE = 256 * 1024
+
+#
+# 二进制模式上传时，是否使用sendfile直接从文件发送到网络，减少数据在内存中的复制
+# 需要Python3，或者安装pysendfile
+#
+TRANSFER_SENDFILE = True
+
+#
+# 增量传输，修改过的文件只发送有变化的部分
+# 文件按DELTA_BLOCK_SIZE字节分块计算校验和（MD5）：
+# local : 与上次写入时的各数据块校验和比较，只写入有变化的数据块
+# ftp   : 上次上传的内容没有变化、只在末尾追加了内容的文件（例如日志），只追加上传（APPE）新的内容
+# 需要INDEX_FILE记录上次上传时的校验和，只对不小于DELTA_MIN_SIZE字节的文件使用增量传输
+#
+TRANSFER_DELTA = True
+DELTA_BLOCK_SIZE = 64 * 1024
+DELTA_MIN_SIZE = 1024 * 1024
+
+#
+# 执行失败的任务（例如FTP服务器中断期间的变化）按指数退避重试，等待时间加入随机抖动
+# 第n次重试前等待RETRY_BASE_DELAY * 2^(n-1)秒，最多等待RETRY_MAX_DELAY秒
+# 重试队列保存在INDEX_FILE中，守护进程重启后继续重试；INDEX_FILE为None时保存在内存中
+# 每隔RETRY_CHECK_INTERVAL秒检查一次服务器连接，连接恢复后立即重试所有任务
+# 重试RETRY_MAX_ATTEMPTS次仍然失败，或者重试队列超过RETRY_SPOOL_SIZE个任务时，
+# 任务写入死信文件RETRY_DEAD_LETTER_FILE（每行一个JSON），不再重试
+# RETRY_MAX_ATTEMPTS为0表示不重试
+#
+RETRY_MAX_ATTEMPTS = 10
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 600
+RETRY_CHECK_INTERVAL = 5
+RETRY_SPOOL_SIZE = 100000
+RETRY_DEAD_LETTER_FILE = os.path.join('/var/lib/', os.path.splitext(os.path.basename(sys.argv[0]))[0], 'dead-letter.log')
+
+#
+# 运行指标（事件和FTP命令的次数、耗时，上传字节数，同步延迟，队列长度等）的HTTP接口
+# 以Prometheus文本格式输出，例如：shell> curl http://127.0.0.1:9109/metrics
+# 值为host:port，或者以/开头的Unix socket路径，例如：'127.0.0.1:9109'、'/var/run/ftp-inotify.sock'
+# 使用None，则不开启该接口
+#
+METRICS_LISTEN = None
+
+#
+# 停止守护进程（SIGTERM）时，等待上传队列中的任务执行完成的最长时间（秒）
+# 超时后仍未完成的任务（包括正在上传的）保存到重试队列中（需要INDEX_FILE），守护进程直接退出，
+# 正在上传的文件被中断，下次启动时重新执行
+#
+SHUTDOWN_TIMEOUT = 30
+
+#
+# 外部配置文件，内容为Python代码，可以覆盖上面的任意配置项，例如：
+# WATCH_PATH = '/data/www/'
+# FILTER_EXCLUDE = ['*.tmp']
+# 启动时读取；守护进程收到SIGHUP信号（shell> python ftp-inotify.py --reload）时重新读取，不需要重启
+# RESTART_SETTINGS中的配置项修改后需要重启才能生效
+# 在/etc/下，使用和脚本同名的文件，例如：/etc/ftp-inotify.conf，文件不存在时不读取
+#
+CONFIG_FILE = os.path.join('/etc/', os.path.splitext(os.path.basename(sys.argv[0]))[0] + '.conf')
+
 ################################################################################
 # 配置信息结束
 # 后续代码如果您不了解，请勿修改
 ################################################################################
 
+# 所有的配置项及其默认值
+SETTINGS = dict((key, value) for key, value in globals().items() if key.isupper())
+
+# 重新读取配置文件时不能应用、需要重启守护进程的配置项
+RESTART_SETTINGS = set(['IS_DEBUG', 'PID_FILE', 'LOG_FILE', 'INDEX_FILE', 'RETRY_DEAD_LETTER_FILE', 'METRICS_LISTEN', 'CONFIG_FILE',
+                        'TRANSFER_QUEUE_SIZE', 'TRANSFER_QUEUE_FULL_POLICY', 'TRANSFER_QUEUE_TIMEOUT', 'TRANSFER_POOL_SIZE',
+                        'REMOTE_CACHE_SIZE', 'REMOTE_CACHE_TTL', 'TRANSFER_BLOCK_SIZE', 'DELTA_BLOCK_SIZE'])
+
+def load_config(filename):
+    """读取外部配置文件，返回其中的配置项"""
+    scope = {}
+    execfile(filename, scope)
+    settings = dict((key, value) for key, value in scope.items() if key.isupper())
+    unknown = [key for key in settings if key not in SETTINGS]
+    if unknown:
+        raise ValueError('unknown settings: %s' % (', '.join(sorted(unknown))))
+    return settings
+
+# 读取外部配置文件，覆盖上面的配置项
+if CONFIG_FILE and os.path.isfile(CONFIG_FILE):
+    try:
+        globals().update(load_config(CONFIG_FILE))
+    except Exception as e:
+        print >>sys.stderr, 'Loading config file failed: path=%s, error=%s.' % (CONFIG_FILE, e)
+        sys.exit()
+
 #
 # 初始化日志
 #
@@ -129,57 +441,149 @@ if LOG_FILE:
         
         synclogger.removeHandler(default_hdlr)
 
-# 检查监视路径是否正确
-if not WATCH_PATH:
-    synclogger.error('The WATCH_PATH setting MUST be set.')
-    print >>sys.stderr, 'The WATCH_PATH setting MUST be set.'
-    sys.exit()
-else:
-    if os.path.exists(WATCH_PATH):
-        synclogger.info('Found watch path: path=%s.' % (WATCH_PATH))
+# 检查索引文件路径是否正确
+if INDEX_FILE:
+    INDEX_DIR = os.path.dirname(INDEX_FILE)
+    if not os.path.exists(INDEX_DIR):
+        try:
+            os.makedirs(INDEX_DIR)
+            synclogger.info('The dir of index NOT exists, created now: path=%s' % INDEX_DIR)
+        except Exception as e:
+            synclogger.error('The dir of index NOT exists and created failed, path=%s.' % INDEX_DIR)
+            print >>sys.stderr, 'The dir of index NOT exists and created failed, path=%s.' % INDEX_DIR
+            sys.exit()
+    elif not os.access(INDEX_DIR, os.W_OK):
+        synclogger.error('The dir of index is NOT writeable: path=%s.' % INDEX_DIR)
+        print >>sys.stderr, 'The dir of index is NOT writeable: path=%s.' % INDEX_DIR
+        sys.exit()
     else:
-        synclogger.error('The watch path NOT exists, daemon stop now: path=%s.' % (WATCH_PATH))
-        print >>sys.stderr, 'The watch path NOT exists, daemon stop now: path=%s.' % (WATCH_PATH)
+        synclogger.debug('The index file is: path=%s.' % INDEX_FILE)
+
+# 检查死信文件路径是否正确
+if RETRY_DEAD_LETTER_FILE:
+    DEAD_LETTER_DIR = os.path.dirname(RETRY_DEAD_LETTER_FILE)
+    if not os.path.exists(DEAD_LETTER_DIR):
+        try:
+            os.makedirs(DEAD_LETTER_DIR)
+            synclogger.info('The dir of dead letter NOT exists, created now: path=%s' % DEAD_LETTER_DIR)
+        except Exception as e:
+            synclogger.error('The dir of dead letter NOT exists and created failed, path=%s.' % DEAD_LETTER_DIR)
+            print >>sys.stderr, 'The dir of dead letter NOT exists and created failed, path=%s.' % DEAD_LETTER_DIR
+            sys.exit()
+    elif not os.access(DEAD_LETTER_DIR, os.W_OK):
+        synclogger.error('The dir of dead letter is NOT writeable: path=%s.' % DEAD_LETTER_DIR)
+        print >>sys.stderr, 'The dir of dead letter is NOT writeable: path=%s.' % DEAD_LETTER_DIR
         sys.exit()
 
-# 允许同步的文件类型（转换成正则表达式）
-if FILE_TYPES:
-    FILE_TYPES_PATTERN = re.compile("^(%s)/" % re.sub(' *, *', '|', FILE_TYPES))
-    synclogger.debug('Watch file types: %s.' % FILE_TYPES)
-else:
-    synclogger.debug('Watch all types of file.')
+def check_config():
+    """检查可以在运行中重新读取的配置项，返回错误信息，没有错误时返回None"""
+    global UPLOAD_TARGETS, WATCH_ROOT_CONFIGS
 
-# 允许同步的文件扩展名（转换成正则表达式）
-if FILE_EXTENSIONS:
-    FILE_EXTENSIONS_PATTERN = re.compile("^(%s)$" % re.sub(' *, *', '|', FILE_EXTENSIONS))
-    synclogger.debug('Watch file extensions: %s.' % FILE_EXTENSIONS)
-else:
-    synclogger.debug('Watch all extensions of file.')
+    # 检查监视路径是否正确
+    if WATCH_ROOTS:
+        roots = copy.deepcopy(WATCH_ROOTS)
+    elif WATCH_PATH:
+        roots = [{'path': WATCH_PATH}]
+    else:
+        return 'The WATCH_PATH setting MUST be set.'
 
-# FTP主机地址
-if UPLOAD_FTP_HOST:
-    synclogger.debug('Found host for ftp server: %s.' % (UPLOAD_FTP_HOST))
-else:
-    synclogger.error('The host for ftp server MUST be set.')
-    print >>sys.stderr, 'The host for ftp server MUST be set.' % (UPLOAD_FTP_HOST)
+    for root in roots:
+        if not root.get('path') or not os.path.isdir(root['path']):
+            return 'The watch path NOT exists, daemon stop now: path=%s.' % (root.get('path'))
+        root['path'] = os.path.join(os.path.abspath(root['path']), '')
+        synclogger.info('Found watch path: path=%s.' % (root['path']))
+
+    paths = sorted(root['path'] for root in roots)
+    for index in range(1, len(paths)):
+        if paths[index].startswith(paths[index - 1]):
+            return 'The watch paths MUST NOT contain each other: path=%s, path=%s.' % (paths[index - 1], paths[index])
+
+    # 同步的目标FTP服务器
+    if UPLOAD_FTP_TARGETS:
+        targets = copy.deepcopy(UPLOAD_FTP_TARGETS)
+    else:
+        targets = [{'name': 'default', 'host': UPLOAD_FTP_HOST, 'user': UPLOAD_FTP_USER, 'pass': UPLOAD_FTP_PASS}]
+
+    for index, target in enumerate(targets):
+        target.setdefault('name', target.get('host') or target.get('path') or 'target-%d' % (index + 1))
+        target.setdefault('transport', 'ftp')
+
+        if target['transport'] == 'local':
+            # 本地目录
+            if not target.get('path') or not os.path.isdir(target['path']):
+                return 'The path for local target NOT exists: target=%s, path=%s.' % (target['name'], target.get('path'))
+        elif target['transport'] == 'ftp':
+            # FTP主机地址、用户名、密码
+            for key, label in (('host', 'host'), ('user', 'username'), ('pass', 'password')):
+                if not target.get(key):
+                    return 'The %s for ftp server MUST be set: target=%s.' % (label, target['name'])
+                synclogger.debug('Found %s for ftp server: target=%s.' % (label, target['name']))
+        else:
+            return 'The transport is invalid: target=%s, transport=%s.' % (target['name'], target['transport'])
+
+    # 监视路径同步到的目标服务器
+    names = set(target['name'] for target in targets)
+    for root in roots:
+        unknown = [name for name in root.get('targets') or [] if name not in names]
+        if unknown:
+            return 'The targets for watch path NOT exist: path=%s, targets=%s.' % (root['path'], ', '.join(unknown))
+
+    # 上传限速：每秒字节数，或者[(开始时间, 结束时间, 每秒字节数), ...]
+    limits = [('global', TRANSFER_RATE_LIMIT)] + [(target['name'], target.get('rate_limit', 0)) for target in targets]
+    for name, rate in limits:
+        periods = rate if isinstance(rate, (list, tuple)) else [('00:00', '00:00', rate)]
+        for period in periods:
+            if (not isinstance(period, (list, tuple)) or len(period) != 3 or
+                    not isinstance(period[2], (int, long, float)) or period[2] < 0 or
+                    not all(isinstance(clock, str) and re.match(r'^([01]\d|2[0-3]):[0-5]\d$', clock) for clock in period[:2])):
+                return 'The rate limit is invalid: target=%s, rate=%r.' % (name, rate)
+
+    # 上传任务的优先级
+    classes = set()
+    for klass in TRANSFER_PRIORITY_CLASSES:
+        if not klass.get('name') or klass['name'] in classes or klass['name'] in ('meta', 'default'):
+            return 'The name of priority class is invalid or duplicated: name=%s.' % (klass.get('name'))
+        classes.add(klass['name'])
+    if not isinstance(TRANSFER_PRIORITY_MAX_WAIT, (int, long, float)) or TRANSFER_PRIORITY_MAX_WAIT < 0:
+        return 'The TRANSFER_PRIORITY_MAX_WAIT setting is invalid: %s.' % (TRANSFER_PRIORITY_MAX_WAIT)
+
+    # 上传模式
+    if TRANSFER_MODE not in ('auto', 'binary'):
+        return 'The TRANSFER_MODE setting is invalid: %s.' % (TRANSFER_MODE)
+
+    # 断点续传使用的命令
+    if RESUME_COMMAND not in ('REST', 'APPE'):
+        return 'The RESUME_COMMAND setting is invalid: %s.' % (RESUME_COMMAND)
+
+    UPLOAD_TARGETS = targets
+    WATCH_ROOT_CONFIGS = roots
+    return None
+
+error = check_config()
+if error:
+    synclogger.error(error)
+    print >>sys.stderr, error
     sys.exit()
 
-# FTP用户名
-if UPLOAD_FTP_USER:
-    synclogger.debug('Found username for ftp server: %s.' % (UPLOAD_FTP_USER))
-else:
-    synclogger.error('The username for ftp server MUST be set.')
-    print >>sys.stderr, 'The username for ftp server MUST be set.' % (UPLOAD_FTP_USER)
+# 上传队列已满时的处理策略
+if TRANSFER_QUEUE_FULL_POLICY not in ('block', 'drop_oldest', 'drop_newest'):
+    synclogger.error('The TRANSFER_QUEUE_FULL_POLICY setting is invalid: %s.' % (TRANSFER_QUEUE_FULL_POLICY))
+    print >>sys.stderr, 'The TRANSFER_QUEUE_FULL_POLICY setting is invalid: %s.' % (TRANSFER_QUEUE_FULL_POLICY)
     sys.exit()
 
-# FTP密码
-if UPLOAD_FTP_PASS:
-    synclogger.debug('Found password for ftp server: %s.' % (UPLOAD_FTP_PASS))
-else:
-    synclogger.error('The password for ftp server MUST be set.')
-    print >>sys.stderr, 'Found password for ftp server: %s.' % (UPLOAD_FTP_PASS)
+# 传输线程数量
+if TRANSFER_POOL_SIZE < 1:
+    synclogger.error('The TRANSFER_POOL_SIZE setting MUST be greater than 0.')
+    print >>sys.stderr, 'The TRANSFER_POOL_SIZE setting MUST be greater than 0.'
     sys.exit()
 
+# 运行指标接口的监听地址
+if METRICS_LISTEN and not METRICS_LISTEN.startswith('/'):
+    if not re.match(r'^[^:]*:\d+$', METRICS_LISTEN):
+        synclogger.error('The METRICS_LISTEN setting is invalid: %s.' % (METRICS_LISTEN))
+        print >>sys.stderr, 'The METRICS_LISTEN setting is invalid: %s.' % (METRICS_LISTEN)
+        sys.exit()
+
 ###############################################
 # 完成配置文件检测
 ###############################################
@@ -193,7 +597,156 @@ mask = pyinotify.IN_DELETE | \
        pyinotify.IN_ISDIR | \
        pyinotify.IN_CREATE | \
        pyinotify.IN_MOVED_TO | \
-       pyinotify.IN_MOVED_FROM
+       pyinotify.IN_MOVED_FROM | \
+       pyinotify.IN_Q_OVERFLOW
+
+class Metrics(object):
+    """进程内的计数器和耗时直方图，以Prometheus文本格式输出"""
+
+    # 耗时直方图的分桶上限（秒）
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    counters = {}
+    histograms = {}
+    collectors = []
+    lock = threading.Lock()
+    server = None
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    @staticmethod
+    def inc(name, value=1, **labels):
+        """计数器增加value"""
+        key = Metrics.key(name, labels)
+        with Metrics.lock:
+            Metrics.counters[key] = Metrics.counters.get(key, 0) + value
+
+    @staticmethod
+    def observe(name, value, **labels):
+        """直方图记录一次耗时（秒）"""
+        key = Metrics.key(name, labels)
+        index = bisect.bisect_left(Metrics.buckets, value)
+        with Metrics.lock:
+            histogram = Metrics.histograms.get(key)
+            if histogram is None:
+                histogram = Metrics.histograms[key] = {'buckets': [0] * (len(Metrics.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @staticmethod
+    def collect(name, kind, func):
+        """注册读取时才计算的指标，func返回[(labels, value), ...]"""
+        Metrics.collectors.append((name, kind, func))
+
+    @staticmethod
+    def measure(name, **labels):
+        """装饰器：统计调用次数（区分成功和失败）和耗时"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                result = 'error'
+                try:
+                    value = func(*args, **kwargs)
+                    result = 'ok'
+                    return value
+                finally:
+                    Metrics.inc(name + '_total', result=result, **labels)
+                    Metrics.observe(name + '_seconds', time.time() - start, **labels)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def format(name, labels, value):
+        if labels:
+            pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+            name = '%s{%s}' % (name, ','.join(pairs))
+        return '%s %s' % (name, repr(float(value)) if isinstance(value, float) else value)
+
+    @staticmethod
+    def render():
+        """输出Prometheus文本格式"""
+        with Metrics.lock:
+            counters = sorted(Metrics.counters.items())
+            histograms = sorted((key, copy.deepcopy(value)) for key, value in Metrics.histograms.items())
+
+        lines = []
+        last = None
+        for (name, labels), value in counters:
+            if name != last:
+                lines.append('# TYPE %s counter' % name)
+                last = name
+            lines.append(Metrics.format(name, labels, value))
+
+        for (name, labels), histogram in histograms:
+            if name != last:
+                lines.append('# TYPE %s histogram' % name)
+                last = name
+            count = 0
+            for bound, n in zip(Metrics.buckets + ('+Inf', ), histogram['buckets']):
+                count += n
+                lines.append(Metrics.format(name + '_bucket', labels + (('le', bound), ), count))
+            lines.append(Metrics.format(name + '_sum', labels, histogram['sum']))
+            lines.append(Metrics.format(name + '_count', labels, histogram['count']))
+
+        for name, kind, func in Metrics.collectors:
+            try:
+                values = func()
+            except Exception as e:
+                synclogger.debug("Collecting metric failed: name=%s, error=%s." % (name, e))
+                continue
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in values:
+                lines.append(Metrics.format(name, tuple(sorted(labels.items())), value))
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def start(listen):
+        """启动HTTP接口"""
+        if not listen:
+            return
+
+        if listen.startswith('/'):
+            if os.path.exists(listen):
+                os.remove(listen)
+            Metrics.server = UnixHTTPServer(listen, MetricsHandler)
+        else:
+            host, port = listen.rsplit(':', 1)
+            Metrics.server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+
+        worker = threading.Thread(target=Metrics.server.serve_forever, name='metrics')
+        worker.daemon = True
+        worker.start()
+        synclogger.info("Started metrics server: listen=%s." % (listen))
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """输出运行指标的HTTP请求处理"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = Metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        synclogger.debug("Metrics request: %s." % (format % args))
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
 
 class mgftp(FTP):
     """自定义FTP类，主要增加断线重新连接功能。"""
@@ -220,12 +773,15 @@ class mgftp(FTP):
             if self.ftp_user:
                 try:
                     self.ftp.login(self.ftp_user, self.ftp_pass, self.ftp_acct)
+                    Metrics.inc('sync_ftp_reconnects_total', result='ok')
                     synclogger.info('Reonnected to ftp server success.')
                     return True
                 except Exception as e:
+                    Metrics.inc('sync_ftp_reconnects_total', result='error')
                     synclogger.info('Reonnected to ftp server failed: error=%s.' % e)
                     return False
         else:
+            Metrics.inc('sync_ftp_reconnects_total', result='error')
             synclogger.info('Reonnected to ftp server failed, host is EMPTY.')
             return False
 
@@ -237,41 +793,148 @@ class mgftp(FTP):
         except:
             return False
 
+    @Metrics.measure('sync_ftp_command', command='storlines')
     def storlines(self, cmd, fp, callback=None):
+        position = fp.tell()
         try:
             return self.ftp.storlines(cmd, fp, callback)
         except:
             self.reconnect()
+            fp.seek(position)
             return self.ftp.storlines(cmd, fp, callback)
         
+    @Metrics.measure('sync_ftp_command', command='storbinary')
     def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
+        # 重新上传前，回到文件开始上传的位置
+        position = fp.tell()
         try:
             return self.ftp.storbinary(cmd, fp, blocksize, callback, rest)
         except:
             self.reconnect()
+            fp.seek(position)
             return self.ftp.storbinary(cmd, fp, blocksize, callback, rest)
+
+    @Metrics.measure('sync_ftp_command', command='storfile')
+    def storfile(self, cmd, fp, blocksize=TRANSFER_BLOCK_SIZE, callback=None, rest=None):
+        position = fp.tell()
+        try:
+            return mgftp.send(self.ftp, cmd, fp, blocksize, callback, rest)
+        except:
+            self.reconnect()
+            fp.seek(position)
+            return mgftp.send(self.ftp, cmd, fp, blocksize, callback, rest)
+
+    @staticmethod
+    def send(ftp, cmd, fp, blocksize=TRANSFER_BLOCK_SIZE, callback=None, rest=None):
+        """使用二进制模式，从fp当前的位置开始上传
+
+        可以使用sendfile时由内核直接发送文件内容，否则按blocksize读取后发送。
+        callback的参数为每次发送的字节数。
+        """
+        ftp.voidcmd('TYPE I')
+        conn = ftp.transfercmd(cmd, rest)
+        try:
+            fileno = None
+            if sendfile is not None and TRANSFER_SENDFILE:
+                try:
+                    fileno = fp.fileno()
+                except (AttributeError, IOError, ValueError):
+                    fileno = None
+
+            if fileno is not None:
+                # 由内核直接发送时，按照发送的字节数限速，参考ThrottledFile
+                throttle = getattr(fp, 'throttle', None)
+                offset = fp.tell()
+                while True:
+                    try:
+                        sent = sendfile(conn.fileno(), fileno, offset, blocksize)
+                    except (OSError, IOError) as e:
+                        # 设置了超时的socket是非阻塞的
+                        if e.errno != errno.EAGAIN:
+                            raise
+                        select.select([], [conn], [], conn.gettimeout())
+                        continue
+
+                    if not sent:
+                        break
+                    offset += sent
+                    if throttle:
+                        throttle(sent)
+                    if callback:
+                        callback(sent)
+                fp.seek(offset)
+            else:
+                readinto = getattr(fp, 'readinto', None)
+                if readinto is not None:
+                    buf = bytearray(blocksize)
+                    view = memoryview(buf)
+                    while True:
+                        size = readinto(buf)
+                        if not size:
+                            break
+                        conn.sendall(view[:size])
+                        if callback:
+                            callback(size)
+                else:
+                    while True:
+                        data = fp.read(blocksize)
+                        if not data:
+                            break
+                        conn.sendall(data)
+                        if callback:
+                            callback(len(data))
+        finally:
+            conn.close()
+
+        return ftp.voidresp()
+
+    @Metrics.measure('sync_ftp_command', command='size')
+    def size(self, filename):
+        """读取服务器上文件的大小，文件不存在时返回None"""
+        try:
+            self.ftp.voidcmd('TYPE I')
+            return self.ftp.size(filename)
+        except Exception as e:
+            if str(e).startswith('550'):
+                return None
+            self.reconnect()
+            self.ftp.voidcmd('TYPE I')
+            return self.ftp.size(filename)
         
+    @Metrics.measure('sync_ftp_command', command='rmd')
     def rmd(self, dirname):
         try:
             return self.ftp.rmd(dirname)
+        except error_perm:
+            # 服务器返回的永久错误（例如目录不为空、是目录），连接是正常的
+            raise
         except:
             self.reconnect()
             return self.ftp.rmd(dirname)
         
+    @Metrics.measure('sync_ftp_command', command='delete')
     def delete(self, filename):
         try:
             return self.ftp.delete(filename)
+        except error_perm:
+            # 服务器返回的永久错误（例如目录不为空、是目录），连接是正常的
+            raise
         except:
             self.reconnect()
             return self.ftp.delete(filename)
         
+    @Metrics.measure('sync_ftp_command', command='mkd')
     def mkd(self, dirname):
         try:
             return self.ftp.mkd(dirname)
+        except error_perm:
+            # 服务器返回的永久错误（例如目录已经存在），连接是正常的
+            raise
         except:
             self.reconnect()
             return self.ftp.mkd(dirname)
         
+    @Metrics.measure('sync_ftp_command', command='rename')
     def rename(self, fromname, toname):
         try:
             return self.ftp.rename(fromname, toname)
@@ -279,230 +942,3197 @@ class mgftp(FTP):
             self.reconnect()
             return self.ftp.rename(fromname, toname)
 
-class UploadFtp():
-    """FTP连接和关闭类，其它功能参考ftplib"""
-
-    c = None
-    @staticmethod
-    def connect():
-        """连接远程FTP服务器，如果已有连接则使用旧连接，如果连接出错（如超时）会重新连接。"""
-        if UploadFtp.c is None:
-            UploadFtp.c = mgftp(UPLOAD_FTP_HOST, UPLOAD_FTP_USER, UPLOAD_FTP_PASS)
-            synclogger.info('Connected to ftp server success.')
-            
-        return UploadFtp.c
+    @Metrics.measure('sync_ftp_command', command='retrlines')
+    def retrlines(self, cmd, callback=None):
+        try:
+            return self.ftp.retrlines(cmd, callback)
+        except:
+            self.reconnect()
+            return self.ftp.retrlines(cmd, callback)
 
-    @staticmethod
-    def close():
-        """关闭远程连接FTP"""
-        if UploadFtp.c is not None:
-            try:
-                UploadFtp.c.quit()
-                synclogger.info('Closed to ftp server success.')
-            except Exception as e:
-                synclogger.error('Closing to ftp server failed: %s.' % (e))
+    @Metrics.measure('sync_ftp_command', command='nlst')
+    def nlst(self, *args):
+        try:
+            return self.ftp.nlst(*args)
+        except:
+            self.reconnect()
+            return self.ftp.nlst(*args)
 
-            UploadFtp.c = None
+class Transport(object):
+    """同步目标的传输接口，路径都是相对于同步根目录的远程路径
 
-            return True
-        else:
-            return False
+    put(fp, remote, text, signature)
+                           : 上传fp从当前位置开始的内容，返回实际发送的字节数，
+                             signature为上次上传的内容的(size, sums)，支持时只写入有变化的数据块
+    delete(remote)         : 删除文件
+    mkdir(remote)          : 创建目录
+    rmdir(remote)          : 删除空目录
+    rename(src, dst)       : 重命名文件或目录
+    stat(remote)           : 返回文件大小，不存在时返回None
+    listdir(remote)        : 返回{名称: 是否目录（无法判断时为None）}，目录不存在时返回None
+    copy(src, dst)         : 在服务器上复制文件（可选）
+    """
 
-    @staticmethod
-    def path(local_path):
-        """根据本地路径得到远程FTP路径"""
-        return local_path.replace(WATCH_PATH, '')
+    # 是否支持断点续传和追加上传（REST/APPE）
+    resumable = False
+    # put是否可以按照signature只写入有变化的数据块
+    patchable = False
 
-    @staticmethod
-    def ignore(path):
-        """判断是否需要忽略该文件"""
-        if os.path.exists(path):
-            synclogger.debug("The path exists, checking type now, path=%s." % (path))
+    def put(self, fp, remote, text=False, signature=None):
+        raise NotImplementedError
 
-            if not FILE_TYPES:
-                synclogger.warning("Filter types is NOT setting, sync all types.")
-                return False
-            elif os.path.isdir(path):
-                synclogger.debug("The path is dir, will be synced.")
-                return False
+    def delete(self, remote):
+        raise NotImplementedError
 
-            type, encoding = mimetypes.guess_type(path)
-            synclogger.debug("The path's info: path=%s, type=%s, encoding=%s." % (path, type, encoding))
+    def mkdir(self, remote):
+        raise NotImplementedError
 
-            if type is not None and FILE_TYPES_PATTERN.match(type):
-                synclogger.debug("Matched type: path=%s, type=%s,  condition=%s." % (path, type, FILE_TYPES_PATTERN.pattern))
-                return False
+    def rmdir(self, remote):
+        raise NotImplementedError
 
-            return True
-        else:
-            # 如果监测到删除操作
-            # 因为操作后，路径已经不存在了，因此无法判断文件类型
-            # 只能通过文件路径的扩展名进行猜测
-            synclogger.debug("The path NOT exists, checking extension now, path=%s." % (path))
+    def rename(self, src, dst):
+        raise NotImplementedError
 
-            fileName, fileExtension = os.path.splitext(path)
+    def stat(self, remote):
+        raise NotImplementedError
 
-            # 没有扩展名，默认猜测是目录
-            if not fileExtension:
-                return False
+    def listdir(self, remote):
+        raise NotImplementedError
 
-            if FILE_EXTENSIONS_PATTERN.match(fileExtension):
-                synclogger.debug("Matched type: path=%s, ext=%s, condition=%s." % (path, fileExtension, FILE_EXTENSIONS_PATTERN.pattern))
-                return False
+    def copy(self, src, dst):
+        """在服务器上复制文件，不支持时抛出NotImplementedError"""
+        raise NotImplementedError
 
     @staticmethod
-    def istextfile(filename, blocksize = 512):
-        """判断文件是否是文本文件"""
-        return UploadFtp.istext(open(filename).read(blocksize))
+    def create(config):
+        """按照UPLOAD_FTP_TARGETS中的配置创建传输"""
+        return TRANSPORTS[config['transport']].from_config(config)
 
-    @staticmethod
-    def istext(s):
-        """判断字符串是否是文本"""
-        if "\0" in s:
-            return 0
+    def is_alive(self):
+        return True
 
-        if not s:  # Empty files are considered text
-            return 1
+    def reconnect(self):
+        return True
 
-        text_characters = "".join(map(chr, range(32, 127)) + list("\n\r\t\b"))
-        _null_trans = string.maketrans("", "")
+    def close(self):
+        pass
 
-        # Get the non-text characters (maps a character to itself then
-        # use the 'remove' option to get rid of the text characters.)
-        t = s.translate(_null_trans, text_characters)
+class FtpTransport(mgftp, Transport):
+    """FTP传输，断线后自动重新连接"""
 
-        # If more than 30% non-text characters, then
-        # this is considered a binary file
-        if float(len(t))/len(s) > 0.30:
-            return 0
-        return 1
+    resumable = True
 
-class EventHandler(pyinotify.ProcessEvent):
-    """针对各种磁盘操作的响应方法"""
+    def __init__(self, host='', user='', passwd=''):
+        mgftp.__init__(self, host, user, passwd)
+        self.mlsd = True
+        self.copyable = True
 
-    def process_IN_CLOSE_WRITE(self, event):
-        ftp = UploadFtp.connect()
+    @staticmethod
+    def from_config(config):
+        return FtpTransport(config['host'], config['user'], config['pass'])
 
-        # check ingore
-        if UploadFtp.ignore(event.pathname):
-            synclogger.info("Ignore file: path=%s." % (event.pathname))
-            return None
+    def put(self, fp, remote, text=False, signature=None):
+        position = fp.tell()
+        if text:
+            self.storlines("STOR " + remote, fp)
+        else:
+            self.storfile("STOR " + remote, fp, TRANSFER_BLOCK_SIZE)
+        return fp.tell() - position
 
-        synclogger.debug("Wrote file success: path=%s." % (event.pathname))
+    def mkdir(self, remote):
+        return self.mkd(remote)
+
+    def rmdir(self, remote):
+        return self.rmd(remote)
 
+    def stat(self, remote):
+        return self.size(remote)
+
+    def listdir(self, remote):
+        names = {}
         try:
-            if UploadFtp.istextfile(event.pathname):
-                ftp.storlines("STOR " + UploadFtp.path(event.pathname), open(event.pathname, "r"))
-                synclogger.info("Uploaded text file: local=%s, remote=%s." % (event.pathname, UploadFtp.path(event.pathname)))
-            else:
-                ftp.storbinary("STOR " + UploadFtp.path(event.pathname), open(event.pathname, "rb"), 1024)
-                synclogger.info("Uploaded binary file: local=%s, remote=%s." % (event.pathname, UploadFtp.path(event.pathname)))
+            if self.mlsd:
+                try:
+                    lines = []
+                    self.retrlines('MLSD ' + remote if remote else 'MLSD', lines.append)
+                    for line in lines:
+                        facts, _, name = line.partition(' ')
+                        kind = dict(fact.split('=', 1) for fact in facts.lower().split(';') if '=' in fact).get('type')
+                        if kind in ('cdir', 'pdir') or name in ('.', '..'):
+                            continue
+                        names[name] = kind == 'dir'
+                except Exception as e:
+                    if not str(e).startswith('50'):
+                        raise
+                    # 服务器不支持MLSD命令
+                    self.mlsd = False
+                    synclogger.debug("The ftp server NOT support MLSD, use NLST instead: error=%s." % (e))
+
+            if not self.mlsd:
+                for name in self.nlst(remote) if remote else self.nlst():
+                    name = os.path.basename(name.rstrip('/'))
+                    if name not in ('.', '..'):
+                        names[name] = None
         except Exception as e:
-            synclogger.info("Uploaded file failed: local=%s, remote=%s, error=%s." % (event.pathname, UploadFtp.path(event.pathname), e))
+            if str(e).startswith('550'):
+                return None
+            raise
 
-    def process_IN_DELETE(self, event):
-        ftp = UploadFtp.connect()
+        return names
 
-        # check ingore
-        if UploadFtp.ignore(event.pathname):
-            synclogger.info("Ignore file: path=%s." % (event.pathname))
-            return None
+    def copy(self, src, dst):
+        if not self.copyable:
+            raise NotImplementedError
+        try:
+            self.ftp.sendcmd('SITE CPFR ' + src)
+            self.ftp.sendcmd('SITE CPTO ' + dst)
+        except error_perm as e:
+            # 服务器不支持SITE CPFR/CPTO命令
+            if str(e)[:3] in ('500', '501', '502', '504'):
+                self.copyable = False
+                synclogger.info("The ftp server NOT support SITE CPFR/CPTO, use STOR instead: error=%s." % (e))
+                raise NotImplementedError
+            raise
 
-        if event.mask & pyinotify.IN_ISDIR:
-            synclogger.debug("Removed dir: path=%s." % (event.pathname))
+    def close(self):
+        self.ftp.quit()
 
-            try:
-                wm.rm_watch(event.pathname, rec=True)
-                synclogger.debug("Removed dir to watch list: path=%s." % (event.pathname))
-            except Exception as e:
-                synclogger.error("Removing dir to watch list failed: path=%s, error=%s." % (event.pathname, e))
+class LocalTransport(Transport):
+    """同步到本地目录（例如挂载的NFS、CIFS），已经存在的文件只写入有变化的数据块"""
 
-            try:
-                ftp.rmd(UploadFtp.path(event.pathname))
-                synclogger.info("Removed dir from server: path=%s." % (UploadFtp.path(event.pathname)))
-            except Exception as e:
-                synclogger.error("Removing dir from server failed: path=%s, error=%s." % (UploadFtp.path(event.pathname), e))
+    patchable = True
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def from_config(config):
+        return LocalTransport(config['path'])
+
+    def path(self, remote):
+        return os.path.join(self.root, remote.strip('/'))
+
+    def put(self, fp, remote, text=False, signature=None):
+        path = self.path(remote)
+        # 使用索引中记录的校验和，不读取目标文件，目标文件的大小变化时（例如被其它程序修改）重新写入整个文件
+        if signature is not None and os.path.isfile(path) and os.path.getsize(path) == signature[0]:
+            return BlockDelta.patch(fp, path, signature[1])
+
+        with open(path, 'wb') as dst:
+            shutil.copyfileobj(fp, dst, TRANSFER_BLOCK_SIZE)
+            return dst.tell()
+
+    def delete(self, remote):
+        os.remove(self.path(remote))
+
+    def mkdir(self, remote):
+        os.mkdir(self.path(remote))
+
+    def rmdir(self, remote):
+        os.rmdir(self.path(remote))
+
+    def rename(self, src, dst):
+        os.rename(self.path(src), self.path(dst))
+
+    def copy(self, src, dst):
+        shutil.copyfile(self.path(src), self.path(dst))
+
+    def stat(self, remote):
+        try:
+            return os.stat(self.path(remote)).st_size
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def listdir(self, remote):
+        path = self.path(remote)
+        try:
+            return dict((name, os.path.isdir(os.path.join(path, name))) for name in os.listdir(path))
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise
+
+# 传输方式
+TRANSPORTS = {'ftp': FtpTransport, 'local': LocalTransport}
+
+class BlockDelta():
+    """按固定大小的数据块比较文件内容，只传输有变化的部分"""
+
+    @staticmethod
+    def signature(fp, limit=None, block_size=DELTA_BLOCK_SIZE):
+        """从fp的当前位置开始，最多读取limit字节，计算每个数据块的MD5，返回(读取的字节数, 摘要串)"""
+        size = 0
+        sums = []
+        while limit is None or size < limit:
+            block = fp.read(block_size if limit is None else min(block_size, limit - size))
+            if not block:
+                break
+            size += len(block)
+            sums.append(hashlib.md5(block).digest())
+        return size, ''.join(sums)
+
+    @staticmethod
+    def patch(fp, path, sums, block_size=DELTA_BLOCK_SIZE):
+        """把fp的内容写入已经存在的文件path，sums为path现有内容的校验和，只写入校验和不同的数据块，返回写入的字节数"""
+        written = 0
+        offset = 0
+        with open(path, 'r+b') as dst:
+            index = 0
+            while True:
+                block = fp.read(block_size)
+                if not block:
+                    break
+                if hashlib.md5(block).digest() != sums[index * 16:index * 16 + 16]:
+                    dst.seek(offset)
+                    dst.write(block)
+                    written += len(block)
+                offset += len(block)
+                index += 1
+            dst.truncate(offset)
+
+        return written
+
+class SigningFile(object):
+    """上传时按数据块计算读取的内容的校验和（block_size为None时不计算），hashing时同时计算整个内容的MD5，
+    记录的是实际发送的内容，上传完成后不需要重新读取文件
+
+    不提供fileno()，文件内容不使用sendfile发送；从头读取（seek(0)）时重新计算，跳到其它位置后不再计算。
+    """
+
+    def __init__(self, fp, block_size=DELTA_BLOCK_SIZE, hashing=False):
+        self.fp = fp
+        self.block_size = block_size
+        self.hashing = hashing
+        self.reset(fp.tell() == 0)
+
+    def __getattr__(self, name):
+        if name == 'fileno':
+            raise AttributeError(name)
+        return getattr(self.fp, name)
+
+    def reset(self, valid=True):
+        self.valid = valid
+        self.size = 0
+        self.sums = []
+        self.block = ''
+        self.md5 = hashlib.md5() if self.hashing else None
+
+    def update(self, data):
+        if not self.valid or not data:
+            return
+        self.size += len(data)
+        if self.md5 is not None:
+            self.md5.update(data)
+        if not self.block_size:
+            return
+        self.block += data
+        while len(self.block) >= self.block_size:
+            self.sums.append(hashlib.md5(self.block[:self.block_size]).digest())
+            self.block = self.block[self.block_size:]
+
+    def signature(self):
+        """返回已经读取的内容的(size, sums)，没有从头连续读取时返回None"""
+        if not self.valid:
+            return None
+        sums = self.sums + [hashlib.md5(self.block).digest()] if self.block else self.sums
+        return self.size, ''.join(sums)
+
+    def digest(self):
+        """返回已经读取的内容的MD5，没有从头连续读取时返回None"""
+        if not self.valid or self.md5 is None:
+            return None
+        return self.md5.hexdigest()
+
+    def seek(self, offset, whence=0):
+        self.fp.seek(offset, whence)
+        position = self.fp.tell()
+        if position == 0:
+            self.reset()
+        elif position != self.size:
+            self.valid = False
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.update(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.fp.readline(size)
+        self.update(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.fp.read(len(buf))
+        buf[:len(data)] = data
+        self.update(data)
+        return len(data)
+
+class PathFilter(object):
+    """路径过滤规则，启动时编译为正则表达式，之后只根据路径名和是否目录进行判断，不访问磁盘"""
+
+    def __init__(self, root, include=None, exclude=None, prune=None, types=None, extensions=None, max_size=None):
+        self.root = root.rstrip('/') + '/'
+        self.include = PathFilter.compile(FILTER_INCLUDE if include is None else include)
+        self.exclude = PathFilter.compile(FILTER_EXCLUDE if exclude is None else exclude)
+        self.prune = PathFilter.compile(FILTER_PRUNE_DIRS if prune is None else prune)
+        self.max_size = FILTER_MAX_SIZE if max_size is None else max_size
+        self.extensions = PathFilter.allowed_extensions(FILE_TYPES if types is None else types,
+                                                        FILE_EXTENSIONS if extensions is None else extensions)
+        synclogger.debug("Compiled path filter: root=%s, extensions=%s." % (self.root, 'all' if self.extensions is None else len(self.extensions)))
+
+    @staticmethod
+    def compile(patterns):
+        """把通配符编译为四个正则表达式：(匹配名称, 匹配相对路径, 只匹配目录名称, 只匹配目录的相对路径)
+
+        与gitignore相同，以/结尾的规则只匹配目录，开头或中间有/的规则匹配相对于监视路径的路径，
+        其它规则匹配任意层级的名称。
+        """
+        groups = ([], [], [], [])
+        for pattern in patterns:
+            isdir = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if pattern:
+                groups[isdir * 2 + ('/' in pattern)].append(fnmatch.translate(pattern.lstrip('/')))
+        return tuple(re.compile('|'.join(group)) if group else None for group in groups)
+
+    @staticmethod
+    def allowed_extensions(types, extensions):
+        """根据允许的文件类型和扩展名，得到允许同步的扩展名集合，None表示不限制"""
+        if not types and not extensions:
+            return None
+
+        allowed = set()
+        if types:
+            pattern = re.compile("^(%s)/" % re.sub(' *, *', '|', types.strip()))
+            if not mimetypes.inited:
+                mimetypes.init()
+            for ext, type in mimetypes.types_map.items():
+                if pattern.match(type):
+                    allowed.add(ext.lstrip('.').lower())
+        if extensions:
+            allowed.update(ext.strip().lstrip('.').lower() for ext in extensions.split(',') if ext.strip())
+        return allowed
+
+    @staticmethod
+    def matches(compiled, relpath, isdir=False):
+        """路径本身是否匹配规则"""
+        names, paths, dirnames, dirpaths = compiled
+        name = relpath.rsplit('/', 1)[-1]
+        if (names is not None and names.match(name)) or (paths is not None and paths.match(relpath)):
+            return True
+        return isdir and ((dirnames is not None and dirnames.match(name)) or (dirpaths is not None and dirpaths.match(relpath)))
+
+    @staticmethod
+    def match(compiled, relpath):
+        """文件是否匹配规则，只匹配目录的规则按照文件所在的各级目录匹配"""
+        if PathFilter.matches(compiled, relpath):
+            return True
+
+        dirnames, dirpaths = compiled[2:]
+        if dirnames is None and dirpaths is None:
+            return False
+
+        parts = relpath.split('/')
+        for index in range(1, len(parts)):
+            if (dirnames is not None and dirnames.match(parts[index - 1])) or \
+                    (dirpaths is not None and dirpaths.match('/'.join(parts[:index]))):
+                return True
+        return False
+
+    def relpath(self, path):
+        if path.startswith(self.root):
+            return path[len(self.root):]
+        return path.lstrip('/')
+
+    def pruned(self, relpath):
+        """路径本身或者上级目录是否被排除"""
+        if not any(self.prune):
+            return False
+
+        parts = relpath.split('/')
+        for index in range(len(parts)):
+            if PathFilter.matches(self.prune, '/'.join(parts[:index + 1]), True):
+                return True
+        return False
+
+    def ignore(self, path, isdir=False):
+        """判断是否需要忽略该路径"""
+        relpath = self.relpath(path.rstrip('/'))
+        if not relpath:
+            return False
+
+        if isdir:
+            if self.pruned(relpath):
+                synclogger.debug("Matched prune dir: path=%s." % (path))
+                return True
+            return False
+
+        if self.pruned(os.path.dirname(relpath)):
+            return True
+
+        name = os.path.basename(relpath)
+        if any(self.include) and not PathFilter.match(self.include, relpath):
+            return True
+        if PathFilter.match(self.exclude, relpath):
+            synclogger.debug("Matched exclude rule: path=%s." % (path))
+            return True
+
+        if self.extensions is not None:
+            ext = os.path.splitext(name)[1].lstrip('.').lower()
+            if ext not in self.extensions:
+                return True
+
+        return False
+
+    def oversize(self, size):
+        """文件是否超过允许的大小"""
+        return bool(self.max_size) and size > self.max_size
+
+class WatchRoot(object):
+    """一个监视路径，有各自的服务器路径前缀、过滤规则和目标服务器"""
+
+    def __init__(self, config):
+        self.path = config['path']
+        self.remote = config.get('remote', '').strip('/')
+        # 目标服务器的名称，None表示所有的服务器
+        self.targets = config.get('targets')
+        self.filter = PathFilter(self.path, config.get('include'), config.get('exclude'), config.get('prune'),
+                                 config.get('types'), config.get('extensions'), config.get('max_size'))
+
+    def remote_path(self, local_path):
+        """根据本地路径得到服务器上的路径"""
+        relpath = local_path[len(self.path):] if local_path.startswith(self.path) else ''
+        if not self.remote:
+            return relpath
+        return self.remote + '/' + relpath if relpath else self.remote
+
+class WatchRoots():
+    """所有的监视路径，按路径逐级向上查找所在的监视路径（最长前缀匹配）"""
+
+    # {不带结尾/的监视路径: WatchRoot}
+    roots = None
+
+    @staticmethod
+    def load(configs):
+        """创建监视路径，过滤规则有错误时抛出异常"""
+        roots = collections.OrderedDict()
+        for config in configs:
+            root = WatchRoot(config)
+            roots[root.path.rstrip('/') or '/'] = root
+        return roots
+
+    @staticmethod
+    def all():
+        if WatchRoots.roots is None:
+            WatchRoots.roots = WatchRoots.load(WATCH_ROOT_CONFIGS)
+        return WatchRoots.roots.values()
+
+    @staticmethod
+    def lookup(path):
+        """路径所在的监视路径，不在任何监视路径下时返回None"""
+        if WatchRoots.roots is None:
+            WatchRoots.all()
+
+        path = path.rstrip('/') or '/'
+        while True:
+            root = WatchRoots.roots.get(path)
+            if root is not None:
+                return root
+            if path == '/':
+                return None
+            path = os.path.dirname(path)
+
+class UploadFtp():
+    """本地路径与FTP路径的转换、文件类型判断等工具方法，FTP连接参考Target"""
+
+    @staticmethod
+    def path(local_path):
+        """根据本地路径得到远程FTP路径"""
+        root = WatchRoots.lookup(local_path)
+        return root.remote_path(local_path) if root is not None else local_path
+
+    @staticmethod
+    def ignore(path, isdir=False):
+        """判断是否需要忽略该路径，不在任何监视路径下的路径都忽略"""
+        root = WatchRoots.lookup(path)
+        return root is None or root.filter.ignore(path, isdir)
+
+    @staticmethod
+    def oversize(path, size):
+        """文件是否超过所在监视路径的大小限制"""
+        root = WatchRoots.lookup(path)
+        return root is not None and root.filter.oversize(size)
+
+    @staticmethod
+    def exclude_dir(path):
+        """不需要监视的目录，用于add_watch的exclude_filter参数"""
+        return UploadFtp.ignore(path, True)
+
+    text_characters = "".join(map(chr, range(32, 127)) + list("\n\r\t\b"))
+    null_trans = string.maketrans("", "")
+
+    @staticmethod
+    def istext(s):
+        """判断字符串是否是文本"""
+        if "\0" in s:
+            return 0
+
+        if not s:  # Empty files are considered text
+            return 1
+
+        # Get the non-text characters (maps a character to itself then
+        # use the 'remove' option to get rid of the text characters.)
+        t = s.translate(UploadFtp.null_trans, UploadFtp.text_characters)
+
+        # If more than 30% non-text characters, then
+        # this is considered a binary file
+        if float(len(t))/len(s) > 0.30:
+            return 0
+        return 1
+
+def file_hash(pathname, blocksize=1024 * 1024):
+    """计算文件内容的MD5"""
+    md5 = hashlib.md5()
+    with open(pathname, 'rb') as fp:
+        while True:
+            data = fp.read(blocksize)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+class HashCache():
+    """文件内容MD5的缓存，按最近使用的顺序淘汰，最多缓存DEDUPE_CACHE_SIZE个文件
+
+    文件的大小、修改时间和inode都没有变化时，使用缓存的MD5，不再读取文件内容。
+    计算MD5时距离修改时间不到1秒的结果不缓存，文件系统的时间精度不够时，
+    同一秒内的两次写入可能有相同的大小和修改时间。
+    """
+
+    files = collections.OrderedDict()
+    lock = threading.Lock()
+
+    @staticmethod
+    def version(st):
+        """文件的版本：大小、修改时间和inode"""
+        return (st.st_size, st.st_mtime, st.st_ino)
+
+    @staticmethod
+    def get(pathname):
+        """返回文件内容的MD5，文件不存在或无法读取时返回None"""
+        try:
+            st = os.stat(pathname)
+        except OSError:
+            return None
+
+        version = HashCache.version(st)
+        with HashCache.lock:
+            cached = HashCache.files.pop(pathname, None)
+            if cached is not None and cached[0] == version:
+                HashCache.files[pathname] = cached
+                Metrics.inc('sync_hash_cache_total', result='hit')
+                return cached[1]
+
+        try:
+            digest = file_hash(pathname)
+        except IOError as e:
+            synclogger.debug('Hashing file failed: path=%s, error=%s.' % (pathname, e))
+            return None
+        Metrics.inc('sync_hash_cache_total', result='miss')
+
+        if time.time() - st.st_mtime < 1:
+            return digest
+
+        with HashCache.lock:
+            HashCache.files[pathname] = (version, digest)
+            while len(HashCache.files) > DEDUPE_CACHE_SIZE:
+                HashCache.files.popitem(last=False)
+
+        return digest
+
+class SyncIndex():
+    """同步状态索引，记录每个目标服务器上最后一次同步成功的文件大小和修改时间"""
+
+    conn = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def open(filename):
+        """打开索引文件，不存在则创建"""
+        if SyncIndex.conn is not None or not filename:
+            return SyncIndex.conn
+
+        conn = sqlite3.connect(filename, check_same_thread=False)
+        # 路径按原样的字节串保存，避免非ASCII文件名的编码问题
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                            target TEXT NOT NULL,
+                            path TEXT NOT NULL,
+                            isdir INTEGER NOT NULL DEFAULT 0,
+                            size INTEGER,
+                            mtime REAL,
+                            hash TEXT,
+                            synced REAL,
+                            PRIMARY KEY (target, path))''')
+        conn.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (target, hash)')
+        conn.execute('''CREATE TABLE IF NOT EXISTS partials (
+                            target TEXT NOT NULL,
+                            path TEXT NOT NULL,
+                            size INTEGER,
+                            mtime REAL,
+                            offset INTEGER,
+                            updated REAL,
+                            PRIMARY KEY (target, path))''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS signatures (
+                            target TEXT NOT NULL,
+                            path TEXT NOT NULL,
+                            size INTEGER,
+                            sums BLOB,
+                            PRIMARY KEY (target, path))''')
+        conn.commit()
+        SyncIndex.conn = conn
+        synclogger.info('Opened index file: path=%s.' % (filename))
+        return conn
+
+    @staticmethod
+    def execute(sql, args=()):
+        if SyncIndex.conn is None:
+            return None
+
+        with SyncIndex.lock:
+            try:
+                cursor = SyncIndex.conn.execute(sql, args)
+                SyncIndex.conn.commit()
+                return cursor
+            except sqlite3.Error as e:
+                synclogger.error('Updating index failed: sql=%s, error=%s.' % (sql.split()[0], e))
+                return None
+
+    @staticmethod
+    def record(target, path, size=None, mtime=None, isdir=False, hash=None):
+        """记录同步成功的文件或目录，hash为上传的内容的MD5（没有计算时为None）
+
+        不在上传完成后重新读取文件计算MD5，文件可能已经又被改写，记录的MD5与服务器上的内容不一致时，
+        之后的上传会被当作内容没有变化而跳过。
+        """
+        if SyncIndex.conn is None:
+            return
+
+        SyncIndex.execute('INSERT OR REPLACE INTO files (target, path, isdir, size, mtime, hash, synced) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (target, path.rstrip('/'), int(isdir), size, mtime, hash, time.time()))
+
+    @staticmethod
+    def remove(target, path):
+        """删除文件或目录（包括其下的所有路径）的记录"""
+        path = path.rstrip('/')
+        for table in ('files', 'signatures'):
+            SyncIndex.execute('DELETE FROM %s WHERE target = ? AND (path = ? OR substr(path, 1, ?) = ?)' % table,
+                              (target, path, len(path) + 1, path + '/'))
+
+    @staticmethod
+    def rename(target, src, dst):
+        """重命名文件或目录（包括其下的所有路径）的记录"""
+        src = src.rstrip('/')
+        dst = dst.rstrip('/')
+        for table in ('files', 'signatures'):
+            SyncIndex.execute('DELETE FROM %s WHERE target = ? AND (path = ? OR substr(path, 1, ?) = ?)' % table,
+                              (target, dst, len(dst) + 1, dst + '/'))
+            SyncIndex.execute('UPDATE %s SET path = ? || substr(path, ?) WHERE target = ? AND (path = ? OR substr(path, 1, ?) = ?)' % table,
+                              (dst, len(src) + 1, target, src, len(src) + 1, src + '/'))
+
+    @staticmethod
+    def synced(target, path):
+        """读取最后一次同步成功的文件，返回(size, hash)"""
+        if SyncIndex.conn is None:
+            return None
+
+        with SyncIndex.lock:
+            return SyncIndex.conn.execute('SELECT size, hash FROM files WHERE target = ? AND path = ? AND isdir = 0',
+                                          (target, path)).fetchone()
+
+    @staticmethod
+    def find(target, size, hash, exclude=None):
+        """查找已经同步到目标服务器、内容相同的其它文件"""
+        if SyncIndex.conn is None:
+            return None
+
+        with SyncIndex.lock:
+            row = SyncIndex.conn.execute('SELECT path FROM files WHERE target = ? AND hash = ? AND size = ? AND isdir = 0 AND path != ? LIMIT 1',
+                                         (target, hash, size, exclude or '')).fetchone()
+
+        return row[0] if row is not None else None
+
+    @staticmethod
+    def partial(target, path):
+        """读取未完成的上传，返回(size, mtime, offset)"""
+        if SyncIndex.conn is None:
+            return None
+
+        with SyncIndex.lock:
+            return SyncIndex.conn.execute('SELECT size, mtime, offset FROM partials WHERE target = ? AND path = ?',
+                                          (target, path)).fetchone()
+
+    @staticmethod
+    def progress(target, path, size, mtime, offset):
+        """记录上传进度"""
+        SyncIndex.execute('INSERT OR REPLACE INTO partials (target, path, size, mtime, offset, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                          (target, path, size, mtime, offset, time.time()))
+
+    @staticmethod
+    def finish(target, path):
+        """上传完成，删除上传进度"""
+        SyncIndex.execute('DELETE FROM partials WHERE target = ? AND path = ?', (target, path))
+
+    @staticmethod
+    def signature(target, path):
+        """读取上次上传的文件内容的校验和，返回(size, sums)"""
+        if SyncIndex.conn is None:
+            return None
+
+        with SyncIndex.lock:
+            row = SyncIndex.conn.execute('SELECT size, sums FROM signatures WHERE target = ? AND path = ?',
+                                         (target, path)).fetchone()
+
+        return (row[0], str(row[1])) if row is not None else None
+
+    @staticmethod
+    def sign(target, path, size, sums):
+        """记录上传的文件内容的校验和"""
+        SyncIndex.execute('INSERT OR REPLACE INTO signatures (target, path, size, sums) VALUES (?, ?, ?, ?)',
+                          (target, path, size, sqlite3.Binary(sums)))
+
+    @staticmethod
+    def entries(target, root):
+        """读取目标服务器在root下的所有记录，返回{path: (isdir, size, mtime, hash)}"""
+        if SyncIndex.conn is None:
+            return {}
+
+        root = root.rstrip('/')
+        with SyncIndex.lock:
+            rows = SyncIndex.conn.execute('SELECT path, isdir, size, mtime, hash FROM files WHERE target = ? AND (path = ? OR substr(path, 1, ?) = ?)',
+                                          (target, root, len(root) + 1, root + '/')).fetchall()
+
+        return dict((row[0], (bool(row[1]), row[2], row[3], row[4])) for row in rows)
+
+class SyncTask(object):
+    """同步任务，描述一次需要在FTP服务器上执行的操作"""
+
+    def __init__(self, op, pathname, src_pathname=None, isdir=False, fresh=False):
+        # op可选值：upload、delete、mkd、rmd、rmtree（删除目录及其下的所有内容）、rename
+        # create只用于合并阶段，标记新创建的文件，不会加入上传队列
+        self.op = op
+        self.pathname = pathname
+        self.src_pathname = src_pathname
+        self.isdir = isdir
+        # 路径是否是在合并窗口内新建的（服务器上还没有）
+        self.fresh = fresh
+        # rmd失败（例如目录不为空）时，是否改为删除整个目录树
+        self.expand = True
+        # 已经重试的次数，以及本次执行是否失败
+        self.attempts = 0
+        self.failed = False
+        self.created = time.time()
+        self.updated = self.created
+        # 加入上传队列的时间和优先级（klass为None时还没有分类），参考Priority
+        self.queued = self.created
+        self.priority = 0
+        self.klass = None
+        # 在上传队列中的序号、需要等待完成的相关任务数量、等待该任务完成的任务，参考TransferQueue
+        self.seq = 0
+        self.blockers = 0
+        self.dependents = []
+        # 多个服务器共享的文件内容，参考FileSnapshot
+        self.snapshot = None
+
+    def __repr__(self):
+        if self.src_pathname:
+            return '%s(from=%s, to=%s)' % (self.op, self.src_pathname, self.pathname)
+        return '%s(%s)' % (self.op, self.pathname)
+
+    def release(self):
+        """释放任务持有的文件内容"""
+        if self.snapshot is not None:
+            self.snapshot.release()
+            self.snapshot = None
+
+    def paths(self):
+        """任务涉及的本地路径"""
+        if self.src_pathname:
+            return (self.pathname.rstrip('/'), self.src_pathname.rstrip('/'))
+        return (self.pathname.rstrip('/'), )
+
+def parent_paths(path):
+    """返回路径的所有上级目录"""
+    parents = []
+    parent = os.path.dirname(path)
+    while parent and parent != path:
+        parents.append(parent)
+        path, parent = parent, os.path.dirname(parent)
+    return parents
+
+class PathLocks(object):
+    """记录被占用的路径，用于判断任务之间是否存在先后关系
+
+    相同路径、目录和其下的路径视为相关，相关的任务必须按顺序执行。
+    """
+
+    def __init__(self):
+        # 路径 -> 占用该路径的任务
+        self.exact = {}
+        # 目录 -> 占用其下路径的任务
+        self.ancestors = {}
+
+    def add(self, task):
+        for path in task.paths():
+            self.exact.setdefault(path, set()).add(task)
+            for parent in parent_paths(path):
+                self.ancestors.setdefault(parent, set()).add(task)
+
+    def remove(self, task):
+        for path in task.paths():
+            PathLocks.discard(self.exact, path, task)
+            for parent in parent_paths(path):
+                PathLocks.discard(self.ancestors, parent, task)
+
+    @staticmethod
+    def discard(index, path, task):
+        tasks = index.get(path)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del index[path]
+
+    def conflict(self, task):
+        for path in task.paths():
+            if path in self.exact or path in self.ancestors:
+                return True
+            for parent in parent_paths(path):
+                if parent in self.exact:
+                    return True
+        return False
+
+    def holders(self, task):
+        """返回占用了与task相关的路径的任务"""
+        found = set()
+        for path in task.paths():
+            found.update(self.exact.get(path, ()))
+            found.update(self.ancestors.get(path, ()))
+            for parent in parent_paths(path):
+                found.update(self.exact.get(parent, ()))
+        found.discard(task)
+        return found
+
+class Priority():
+    """上传任务的优先级，数值越小越先执行，参考TRANSFER_PRIORITY_CLASSES"""
+
+    # [(名称, 最大文件大小, 扩展名集合, 路径规则), ...]
+    classes = None
+
+    @staticmethod
+    def load(configs):
+        classes = []
+        for config in configs:
+            classes.append((config['name'], config.get('max_size'), PathFilter.allowed_extensions(None, config.get('extensions')),
+                            PathFilter.compile(config.get('paths') or [])))
+        return classes
+
+    @staticmethod
+    def classify(task, size=None):
+        """返回任务的(优先级, 名称)，size为已经读取的文件大小"""
+        if Priority.classes is None:
+            Priority.classes = Priority.load(TRANSFER_PRIORITY_CLASSES)
+        if not Priority.classes:
+            return (0, 'default')
+        if task.op != 'upload':
+            return (0, 'meta')
+
+        if size is None:
+            try:
+                size = os.path.getsize(task.pathname)
+            except OSError:
+                size = 0
+        name = os.path.basename(task.pathname)
+        ext = os.path.splitext(name)[1].lstrip('.').lower()
+        root = WatchRoots.lookup(task.pathname)
+        relpath = task.pathname[len(root.path):] if root is not None else task.pathname.lstrip('/')
+
+        for index, (klass, max_size, extensions, paths) in enumerate(Priority.classes):
+            if max_size is not None and size > max_size:
+                continue
+            if extensions is not None and ext not in extensions:
+                continue
+            if any(paths) and not PathFilter.match(paths, relpath):
+                continue
+            return (index + 1, klass)
+        return (len(Priority.classes) + 1, 'default')
+
+class TransferQueue(object):
+    """事件处理与FTP传输之间的有界队列
+
+    多个传输线程并行取任务时，与正在执行或排在前面的任务相关的任务需要等待这些任务完成，
+    从而保证同一路径上的操作按照事件发生的顺序执行。可以执行的任务中，优先取出优先级高的任务。
+
+    加入任务时按路径查找相关的任务，记录任务之间的等待关系，任务完成时只检查等待它的任务，
+    取任务时不需要遍历整个队列。
+    """
+
+    def __init__(self, maxsize=0, policy='block', timeout=None):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.timeout = timeout
+        # 等待执行的任务
+        self.tasks = set()
+        self.running = []
+        # 等待执行和正在执行的任务占用的路径
+        self.locks = PathLocks()
+        # 相关的任务都已经完成、可以执行的任务，按(优先级, 序号)排列的堆，
+        # 已经取出或者又需要等待的任务在取出时跳过
+        self.ready = []
+        # 可以执行的任务按加入队列的时间排列的堆，等待时间超过TRANSFER_PRIORITY_MAX_WAIT的任务先执行
+        self.waiting = []
+        # 等待执行的任务按序号排列的堆，用于丢弃最早的任务
+        self.order = []
+        # 加入队列的任务序号递增，插入到最前面的任务序号递减
+        self.last = 0
+        self.first = 0
+        lock = threading.Lock()
+        # 有任务可以执行、队列有空位时，只唤醒一个等待的线程
+        self.available = threading.Condition(lock)
+        self.space = threading.Condition(lock)
+        self.dropped = 0
+        # 丢弃任务时调用，参数为被丢弃的任务
+        self.overflow = None
+
+    def qsize(self):
+        with self.available:
+            return len(self.tasks)
+
+    def full(self):
+        return self.maxsize > 0 and len(self.tasks) >= self.maxsize
+
+    def put(self, task, wait=False, block=True):
+        """加入任务，队列已满时按照配置的策略处理，返回任务是否被加入
+
+        wait为True时，不使用配置的策略，一直等待到队列有空位；
+        block为False时，block策略下不等待，与drop_newest相同，新任务交给overflow处理。
+        """
+        if task.klass is None:
+            task.priority, task.klass = Priority.classify(task)
+        task.queued = time.time()
+        dropped = self.enqueue(task, wait, block)
+        if dropped is not None:
+            if self.overflow is not None:
+                self.overflow(dropped)
+            dropped.release()
+        return dropped is not task
+
+    def enqueue(self, task, wait, block=True):
+        """加入任务，返回被丢弃的任务"""
+        with self.space:
+            if wait:
+                while self.full():
+                    self.space.wait()
+            elif self.full():
+                if self.policy == 'drop_newest' or not block:
+                    self.dropped += 1
+                    synclogger.error("Transfer queue is full, dropped task: task=%r, size=%d." % (task, len(self.tasks)))
+                    return task
+                elif self.policy == 'drop_oldest':
+                    oldest = self.oldest()
+                    self.tasks.discard(oldest)
+                    self.finish(oldest)
+                    self.dropped += 1
+                    synclogger.error("Transfer queue is full, dropped task: task=%r, size=%d." % (oldest, len(self.tasks)))
+                    self.last += 1
+                    self.add(task, self.last)
+                    return oldest
+                else:
+                    synclogger.warning("Transfer queue is full, waiting: size=%d." % (len(self.tasks)))
+                    deadline = time.time() + self.timeout if self.timeout else None
+                    while self.full():
+                        if deadline is None:
+                            self.space.wait()
+                        else:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                break
+                            self.space.wait(remaining)
+
+                    if self.full():
+                        self.dropped += 1
+                        synclogger.error("Transfer queue is full, dropped task: task=%r, size=%d." % (task, len(self.tasks)))
+                        return task
+
+            self.last += 1
+            self.add(task, self.last)
+            synclogger.debug("Queued task: task=%r, size=%d." % (task, len(self.tasks)))
+            return None
+
+    def add(self, task, seq):
+        """加入任务，记录与已有任务之间的等待关系，需要持有锁"""
+        task.seq = seq
+        task.blockers = 0
+        task.dependents = []
+        for other in self.locks.holders(task):
+            if other in self.tasks and other.seq > seq:
+                # 插入到前面的任务，排在后面的相关任务需要等待它完成
+                task.dependents.append((other, other.seq))
+                other.blockers += 1
+            else:
+                other.dependents.append((task, seq))
+                task.blockers += 1
+
+        self.locks.add(task)
+        self.tasks.add(task)
+        heapq.heappush(self.order, (seq, task))
+        if not task.blockers:
+            self.runnable_now(task)
+        self.compact()
+
+    def finish(self, task):
+        """任务执行完成或被丢弃，释放占用的路径，等待该任务的任务可能变为可以执行，需要持有锁"""
+        self.locks.remove(task)
+        dependents, task.dependents = task.dependents, []
+        for other, seq in dependents:
+            # 已经被取出、丢弃或者重新加入的任务不再等待
+            if other.seq != seq or other not in self.tasks:
+                continue
+            other.blockers -= 1
+            if not other.blockers:
+                self.runnable_now(other)
+
+    def runnable_now(self, task):
+        """任务可以执行了，需要持有锁"""
+        heapq.heappush(self.ready, (task.priority, task.seq, task))
+        if TRANSFER_PRIORITY_MAX_WAIT:
+            heapq.heappush(self.waiting, (task.queued, task.seq, task))
+        self.available.notify()
+
+    def compact(self):
+        """堆中跳过的过期项太多时重建，需要持有锁"""
+        if len(self.order) > 2 * len(self.tasks) + 64:
+            self.order = [(task.seq, task) for task in self.tasks]
+            heapq.heapify(self.order)
+        if len(self.ready) > 2 * len(self.tasks) + 64:
+            self.ready = [(task.priority, task.seq, task) for task in self.tasks if not task.blockers]
+            heapq.heapify(self.ready)
+        if len(self.waiting) > 2 * len(self.tasks) + 64:
+            self.waiting = [(task.queued, task.seq, task) for task in self.tasks if not task.blockers] if TRANSFER_PRIORITY_MAX_WAIT else []
+            heapq.heapify(self.waiting)
+
+    def oldest(self):
+        """等待执行的任务中序号最小的任务，需要持有锁"""
+        while True:
+            seq, task = heapq.heappop(self.order)
+            if task.seq == seq and task in self.tasks:
+                return task
+
+    def get(self):
+        """取出可以执行的任务，没有可执行的任务时阻塞等待，任务执行完后需要调用done()"""
+        with self.available:
+            while True:
+                task = self.runnable()
+                if task is not None:
+                    break
+                self.available.wait()
+
+            self.tasks.discard(task)
+            self.running.append(task)
+            self.space.notify()
+            return task
+
+    def runnable(self):
+        """取出可以执行的任务中，优先级最高的第一个任务，需要持有锁
+
+        等待超过TRANSFER_PRIORITY_MAX_WAIT秒的任务不再按优先级，最早加入队列的先执行。
+        """
+        while self.waiting:
+            queued, seq, task = self.waiting[0]
+            if task.seq != seq or task not in self.tasks or task.blockers:
+                heapq.heappop(self.waiting)
+            elif TRANSFER_PRIORITY_MAX_WAIT and time.time() - queued >= TRANSFER_PRIORITY_MAX_WAIT:
+                heapq.heappop(self.waiting)
+                synclogger.debug("Promoted task waited too long: task=%r, priority=%s, seconds=%.2f." % (task, task.klass, time.time() - queued))
+                return task
+            else:
+                break
+
+        while self.ready:
+            _, seq, task = heapq.heappop(self.ready)
+            if task.seq == seq and task in self.tasks and not task.blockers:
+                return task
+        return None
+
+    def push_front(self, tasks):
+        """把任务按顺序插入到队列的最前面，不受队列长度的限制
+
+        用于执行中的任务拆分出的子任务，子任务需要排在所有后来的任务之前。
+        """
+        for task in tasks:
+            if task.klass is None:
+                task.priority, task.klass = Priority.classify(task)
+            task.queued = time.time()
+        with self.available:
+            self.first -= len(tasks)
+            for index, task in enumerate(tasks):
+                self.add(task, self.first + index)
+
+    def drain(self):
+        """取出所有等待执行的任务"""
+        with self.available:
+            tasks = sorted(self.tasks, key=lambda task: task.seq)
+            for task in tasks:
+                self.locks.remove(task)
+            self.tasks.clear()
+            self.ready = []
+            self.waiting = []
+            self.order = []
+            self.space.notify_all()
+            return tasks
+
+    def done(self, task):
+        """标记任务执行完成，释放任务占用的路径"""
+        with self.available:
+            self.running.remove(task)
+            self.finish(task)
+
+class RateLimit(object):
+    """令牌桶限速，多个传输线程共享，参考TRANSFER_RATE_LIMIT
+
+    每次发送数据前取出令牌，令牌不足时等待；空闲时最多积累1秒的令牌。
+    """
+
+    def __init__(self, rate, name):
+        self.rate = rate
+        self.name = name
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def current(self, now):
+        """当前时间的限速，0表示不限速"""
+        if not isinstance(self.rate, (list, tuple)):
+            return self.rate
+
+        clock = time.strftime('%H:%M', time.localtime(now))
+        for start, end, rate in self.rate:
+            # 结束时间小于开始时间的时间段跨过0点
+            if (start <= clock < end) if start <= end else (clock >= start or clock < end):
+                return rate
+        return 0
+
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            rate = self.current(now)
+            if not rate:
+                self.tokens = 0.0
+                self.updated = now
+                return
+
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate) - size
+            self.updated = now
+            wait = -self.tokens / rate
+
+        if wait > 0:
+            Metrics.inc('sync_throttled_seconds_total', wait, limit=self.name)
+            time.sleep(wait)
+
+class ThrottledFile(object):
+    """按照限速读取上传的文件内容，其它方法直接使用原来的文件对象"""
+
+    def __init__(self, fp, limits):
+        self.fp = fp
+        self.limits = limits
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def throttle(self, size):
+        """发送size字节之前（或之后）调用，超过限速时等待"""
+        for limit in self.limits:
+            limit.consume(size)
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.throttle(len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.fp.readline(size)
+        self.throttle(len(data))
+        return data
+
+    def readinto(self, buf):
+        readinto = getattr(self.fp, 'readinto', None)
+        if readinto is not None:
+            size = readinto(buf)
+        else:
+            data = self.fp.read(len(buf))
+            size = len(data)
+            buf[:size] = data
+        self.throttle(size or 0)
+        return size
+
+class FileSnapshot(object):
+    """同步到多个服务器时共享的文件内容，文件只从磁盘读取一次
+
+    第一个需要上传该文件的服务器读取文件内容，其它服务器直接使用内存中的内容，
+    所有服务器上传完成后释放。文件太大或缓存已满时，各服务器分别从磁盘读取。
+    读取之后文件又发生了变化时，之后上传的服务器不再使用缓存的旧内容。
+    """
+
+    lock = threading.Lock()
+    # 当前所有缓存的总大小
+    used = 0
+
+    def __init__(self, pathname, refs):
+        self.pathname = pathname
+        self.refs = refs
+        self.data = None
+        self.loaded = False
+        self.lock = threading.Lock()
+        # 缓存的内容对应的文件版本（参考HashCache.version）和MD5
+        self.version = None
+        self.digest = None
+
+    def open(self, st):
+        """返回用于读取文件内容的文件对象，以及读取的内容的MD5（从磁盘读取时为None）
+
+        st为上传前读取的文件信息，缓存的内容不是这个版本时从磁盘读取。
+        """
+        with self.lock:
+            if not self.loaded:
+                self.loaded = True
+                self.load()
+
+            if self.data is not None and self.version == HashCache.version(st):
+                return StringIO(self.data), self.digest
+
+        return open(self.pathname, 'rb'), None
+
+    def load(self):
+        with open(self.pathname, 'rb') as fp:
+            st = os.fstat(fp.fileno())
+            size = st.st_size
+            if size > FANOUT_BUFFER_FILE_SIZE:
+                return
+
+            with FileSnapshot.lock:
+                if FileSnapshot.used + size > FANOUT_BUFFER_TOTAL_SIZE:
+                    synclogger.debug("Fan-out buffer is full, read from disk: path=%s, used=%d." % (self.pathname, FileSnapshot.used))
+                    return
+                FileSnapshot.used += size
+
+            data = fp.read()
+            changed = HashCache.version(os.fstat(fp.fileno())) != HashCache.version(st) or len(data) != size
+
+        # 读取过程中文件发生了变化时不缓存，各服务器分别从磁盘读取
+        with FileSnapshot.lock:
+            FileSnapshot.used -= size
+            if not changed:
+                FileSnapshot.used += len(data)
+
+        if changed:
+            synclogger.debug("The file changed while reading, read from disk: path=%s." % (self.pathname))
+            return
+
+        self.data = data
+        self.version = HashCache.version(st)
+        if INDEX_HASH or DEDUPE:
+            self.digest = hashlib.md5(data).hexdigest()
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs <= 0 and self.data is not None:
+                with FileSnapshot.lock:
+                    FileSnapshot.used -= len(self.data)
+                self.data = None
+
+class RemoteCache(object):
+    """服务器上目录列表的缓存
+
+    缓存中没有时不读取目录列表，由调用者直接执行命令；删除目录树时读取的目录列表
+    （FTP为MLSD，不支持时使用NLST）和执行成功的操作同时更新缓存，
+    按照最近使用的顺序淘汰，最多缓存REMOTE_CACHE_SIZE个目录。路径均为FTP路径。
+    """
+
+    def __init__(self, size=REMOTE_CACHE_SIZE, ttl=REMOTE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        # 目录 -> {'names': {文件名: 是否目录}, 'complete': 是否是完整的列表, 'time': 读取时间}
+        self.dirs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # 正在读取列表的目录 -> 读取中的数量，以及读取期间被修改的目录 -> 修改时的版本号
+        self.listing = {}
+        self.changed = {}
+        self.generation = 0
+
+    @staticmethod
+    def split(path):
+        path = path.strip('/')
+        return os.path.dirname(path), os.path.basename(path)
+
+    def entry(self, dirname, create=False):
+        """读取目录的缓存，同时更新最近使用的顺序"""
+        entry = self.dirs.pop(dirname, None)
+        if entry is not None and self.ttl and time.time() - entry['time'] > self.ttl:
+            entry = None
+
+        if entry is None and create:
+            entry = {'names': {}, 'complete': False, 'time': time.time()}
+
+        if entry is not None:
+            self.dirs[dirname] = entry
+            while len(self.dirs) > self.size:
+                self.dirs.popitem(last=False)
+
+        return entry
+
+    def lookup(self, path):
+        """判断路径是否存在：True存在，False不存在，None未知"""
+        if not self.size:
+            return None
+
+        dirname, name = RemoteCache.split(path)
+        with self.lock:
+            entry = self.entry(dirname)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if name in entry['names']:
+                return True
+            elif entry['complete']:
+                return False
+            return None
+
+    def list(self, transport, dirname):
+        """读取目录列表并加入缓存，目录不存在时返回None，读取失败时抛出异常
+
+        读取期间其它线程修改了该目录（added/removed/invalidate）时，读取的列表可能已经过时，不加入缓存。
+        """
+        with self.lock:
+            self.listing[dirname] = self.listing.get(dirname, 0) + 1
+            start = self.generation
+
+        try:
+            names = transport.listdir(dirname)
+        finally:
+            with self.lock:
+                stale = self.changed.get(dirname, start) > start
+                self.listing[dirname] -= 1
+                if not self.listing[dirname]:
+                    del self.listing[dirname]
+                    self.changed.pop(dirname, None)
+
+        if names is None:
+            # 目录不存在
+            synclogger.debug("Listed dir NOT exists in server: path=%s." % (dirname))
+            self.removed(dirname)
+            return None
+
+        if stale:
+            synclogger.debug("Listed dir changed while listing, NOT cached: path=%s." % (dirname))
+            return names
+
+        with self.lock:
+            self.dirs.pop(dirname, None)
+            self.entry(dirname, create=True).update({'names': names, 'complete': True, 'time': time.time()})
+        synclogger.debug("Listed dir in server: path=%s, count=%d." % (dirname, len(names)))
+        return names
+
+    def touch(self, path, subdirs=False):
+        """记录正在读取列表的目录被修改（调用时需要持有锁），subdirs时包括其下的目录"""
+        for dirname in self.listing:
+            if dirname == path or (subdirs and dirname.startswith(path + '/')):
+                self.generation += 1
+                self.changed[dirname] = self.generation
+
+    def added(self, path, isdir=False, empty=True):
+        """路径创建成功，empty为False时是已经存在的目录（例如MKD返回550），其中的内容未知"""
+        if not self.size:
+            return
+
+        dirname, name = RemoteCache.split(path)
+        with self.lock:
+            self.touch(dirname)
+            self.entry(dirname, create=True)['names'][name] = isdir
+
+            if isdir and empty:
+                # 新创建的目录是空的
+                self.touch(path.strip('/'))
+                self.dirs.pop(path.strip('/'), None)
+                self.entry(path.strip('/'), create=True)['complete'] = True
+
+    def removed(self, path):
+        """路径删除成功"""
+        if not self.size:
+            return
+
+        path = path.strip('/')
+        dirname, name = RemoteCache.split(path)
+        with self.lock:
+            self.touch(dirname)
+            self.touch(path, subdirs=True)
+            entry = self.entry(dirname)
+            if entry is not None:
+                entry['names'].pop(name, None)
+
+            for key in self.dirs.keys():
+                if key == path or key.startswith(path + '/'):
+                    del self.dirs[key]
+
+    def renamed(self, src, dst, isdir=False):
+        """路径重命名成功"""
+        self.removed(dst)
+        self.removed(src)
+        # 目录中的内容未知
+        self.added(dst, isdir, empty=False)
+
+    def invalidate(self, path):
+        """操作失败时，清除路径所在目录的缓存"""
+        dirname = RemoteCache.split(path)[0]
+        with self.lock:
+            self.touch(dirname)
+            self.dirs.pop(dirname, None)
+
+class Target(object):
+    """同步的目标服务器，有各自的上传队列、传输线程和连接（传输方式见Transport）"""
+
+    def __init__(self, config):
+        self.name = config['name']
+        self.config = config
+        self.pool_size = config.get('pool_size') or TRANSFER_POOL_SIZE
+        self.queue = TransferQueue(TRANSFER_QUEUE_SIZE, TRANSFER_QUEUE_FULL_POLICY, TRANSFER_QUEUE_TIMEOUT)
+        self.queue.overflow = self.spill
+        self.workers = []
+        self.cache = RemoteCache()
+        self.limit = RateLimit(config.get('rate_limit', 0), self.name)
+        # 每个传输线程使用各自的连接
+        self.local = threading.local()
+        # 配置的版本，重新读取配置后各传输线程重新连接
+        self.generation = 0
+
+    def reconfigure(self, config):
+        """应用新的配置，之后执行的任务使用新的连接"""
+        self.config = config
+        self.pool_size = config.get('pool_size') or TRANSFER_POOL_SIZE
+        self.generation += 1
+        self.cache = RemoteCache()
+        self.limit.rate = config.get('rate_limit', 0)
+        synclogger.info('Reconfigured target: target=%s, transport=%s.' % (self.name, config['transport']))
+
+    def connect(self):
+        """连接目标服务器，如果当前线程已有连接则使用旧连接，如果连接出错（如超时）会重新连接。"""
+        if getattr(self.local, 'c', None) is not None and self.local.generation != self.generation:
+            self.close()
+
+        if getattr(self.local, 'c', None) is None:
+            self.local.generation = self.generation
+            self.local.c = Transport.create(self.config)
+            synclogger.info('Connected to server success: target=%s, transport=%s, thread=%s.' % (self.name, self.config['transport'], threading.current_thread().name))
+
+        return self.local.c
+
+    def close(self):
+        """关闭当前线程到目标服务器的连接"""
+        if getattr(self.local, 'c', None) is not None:
+            try:
+                self.local.c.close()
+                synclogger.info('Closed to server success: target=%s.' % (self.name))
+            except Exception as e:
+                synclogger.error('Closing to server failed: target=%s, error=%s.' % (self.name, e))
+
+            self.local.c = None
+
+            return True
+        else:
+            return False
+
+    def start(self):
+        """启动传输线程池"""
+        while len(self.workers) < self.pool_size:
+            worker = threading.Thread(target=self.loop, name='%s-%d' % (self.name, len(self.workers) + 1))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        synclogger.debug("Started transfer threads: target=%s, pool_size=%d, queue_size=%d, policy=%s." % (self.name, self.pool_size, TRANSFER_QUEUE_SIZE, TRANSFER_QUEUE_FULL_POLICY))
+
+    def put(self, task, wait=False, block=True):
+        """加入上传队列"""
+        return self.queue.put(task, wait, block)
+
+    def spill(self, task):
+        """上传队列已满时被丢弃的任务，保存到重试队列稍后执行，无法重试时重新扫描所在的目录"""
+        if RETRY_MAX_ATTEMPTS > 0 and RetrySpool.conn is not None and RetrySpool.count < RETRY_SPOOL_SIZE:
+            RetrySpool.persist(self.name, [task], 'the transfer queue is full')
+        else:
+            Rescanner.put(os.path.dirname(task.pathname.rstrip('/')), 'queue full')
+
+    def loop(self):
+        while True:
+            task = self.queue.get()
+            # 各优先级的任务在上传队列中等待的时间
+            Metrics.observe('sync_queue_wait_seconds', time.time() - task.queued, target=self.name, priority=task.klass)
+            try:
+                self.execute(task)
+                if not task.failed:
+                    RetrySpool.succeeded(self.name, task)
+            except Exception as e:
+                Metrics.inc('sync_task_errors_total', target=self.name, op=task.op)
+                synclogger.error("Executing task failed: target=%s, task=%r, error=%s." % (self.name, task, e))
+                self.retry(task, e)
+            finally:
+                task.release()
+                self.queue.done(task)
+                # 从发生变化到在服务器上执行完成的延迟
+                Metrics.observe('sync_lag_seconds', time.time() - task.created, target=self.name, op=task.op)
+
+    def execute(self, task):
+        """在目标服务器上执行任务"""
+        transport = self.connect()
+
+        if task.op == 'upload':
+            self.upload(transport, task)
+        elif task.op == 'delete':
+            remote = UploadFtp.path(task.pathname)
+            if self.cache.lookup(remote) is False:
+                SyncIndex.remove(self.name, task.pathname)
+                synclogger.debug("The file NOT exists in server, skipped: target=%s, path=%s." % (self.name, remote))
+                return
+
+            try:
+                transport.delete(remote)
+                SyncIndex.remove(self.name, task.pathname)
+                self.cache.removed(remote)
+                synclogger.info("Removed file from server: target=%s, path=%s." % (self.name, remote))
+            except Exception as e:
+                if Target.missing(e):
+                    SyncIndex.remove(self.name, task.pathname)
+                    self.cache.removed(remote)
+                    synclogger.debug("The file NOT exists in server, skipped: target=%s, path=%s, error=%s." % (self.name, remote, e))
+                    return
+                self.cache.invalidate(remote)
+                synclogger.error("Removing file from server failed: target=%s, path=%s, error=%s." % (self.name, remote, e))
+                self.retry(task, e)
+        elif task.op == 'rmd':
+            remote = UploadFtp.path(task.pathname)
+            if self.cache.lookup(remote) is False:
+                SyncIndex.remove(self.name, task.pathname)
+                synclogger.debug("The dir NOT exists in server, skipped: target=%s, path=%s." % (self.name, remote))
+                return
+
+            try:
+                transport.rmdir(remote)
+                SyncIndex.remove(self.name, task.pathname)
+                self.cache.removed(remote)
+                synclogger.info("Removed dir from server: target=%s, path=%s." % (self.name, remote))
+            except Exception as e:
+                self.cache.invalidate(remote)
+                if task.expand:
+                    # 服务器上的目录不为空，例如遗漏了其下文件的删除事件
+                    synclogger.debug("Removing dir from server failed, removing dir tree: target=%s, path=%s, error=%s." % (self.name, remote, e))
+                    self.rmtree(transport, task)
+                else:
+                    synclogger.error("Removing dir from server failed: target=%s, path=%s, error=%s." % (self.name, remote, e))
+                    self.retry(task, e)
+        elif task.op == 'rmtree':
+            self.rmtree(transport, task)
+        elif task.op == 'mkd':
+            remote = UploadFtp.path(task.pathname)
+            if self.cache.lookup(remote):
+                SyncIndex.record(self.name, task.pathname, isdir=True)
+                synclogger.debug("The dir exists in server, skipped: target=%s, path=%s." % (self.name, remote))
+                return
+
+            try:
+                self.makedirs(transport, os.path.dirname(remote.rstrip('/')))
+                if self.mkdir(transport, remote):
+                    synclogger.info("Created new dir in server: target=%s, path=%s." % (self.name, remote))
+                else:
+                    synclogger.debug("The dir exists in server, skipped: target=%s, path=%s." % (self.name, remote))
+                SyncIndex.record(self.name, task.pathname, isdir=True)
+            except Exception as e:
+                self.cache.invalidate(remote)
+                synclogger.error("Created new dir in server failed: target=%s, path=%s, error=%s." % (self.name, remote, e))
+                self.retry(task, e)
+        elif task.op == 'rename':
+            kind = 'dir' if task.isdir else 'file'
+            try:
+                transport.rename(UploadFtp.path(task.src_pathname), UploadFtp.path(task.pathname))
+                SyncIndex.rename(self.name, task.src_pathname, task.pathname)
+                self.cache.renamed(UploadFtp.path(task.src_pathname), UploadFtp.path(task.pathname), task.isdir)
+                synclogger.info("Renamed %s in server: target=%s, from=%s, to=%s." % (kind, self.name, UploadFtp.path(task.src_pathname), UploadFtp.path(task.pathname)))
+            except Exception as e:
+                self.cache.invalidate(UploadFtp.path(task.src_pathname))
+                self.cache.invalidate(UploadFtp.path(task.pathname))
+                synclogger.error("Renamed %s failed in server: target=%s, from=%s, to=%s, error=%s." % (kind, self.name, UploadFtp.path(task.src_pathname), UploadFtp.path(task.pathname), e))
+                self.retry(task, e)
+        else:
+            synclogger.error("Unknown task: target=%s, task=%r." % (self.name, task))
+
+    def rmtree(self, transport, task):
+        """删除服务器上的目录树
+
+        读取目录树后，把其下的文件删除（DELE）和目录删除（RMD，从下往上）拆分为子任务，
+        插入到上传队列的最前面，由传输线程池并行执行。
+        目录列表无法区分文件和目录（NLST）时，直接执行DELE，返回永久错误（5xx）的作为目录继续读取。
+        """
+        remote = UploadFtp.path(task.pathname)
+        files = []
+        dirs = []
+
+        stack = ['']
+        while stack:
+            relpath = stack.pop()
+            names = self.cache.list(transport, os.path.join(remote, relpath) if relpath else remote)
+            if names is None and not relpath:
+                SyncIndex.remove(self.name, task.pathname)
+                synclogger.debug("The dir NOT exists in server, skipped: target=%s, path=%s." % (self.name, remote))
+                return
+            if not names:
+                continue
+
+            for name, isdir in names.items():
+                child = os.path.join(relpath, name) if relpath else name
+                if isdir is None:
+                    isdir = not self.unlink(transport, os.path.join(remote, child))
+                    if not isdir:
+                        continue
+                if isdir:
+                    dirs.append(child)
+                    stack.append(child)
+                else:
+                    files.append(child)
+
+        tasks = [SyncTask('delete', os.path.join(task.pathname, child)) for child in files]
+        for child in sorted(dirs, key=lambda path: path.count('/'), reverse=True):
+            tasks.append(SyncTask('rmd', os.path.join(task.pathname, child), isdir=True))
+        tasks.append(SyncTask('rmd', task.pathname, isdir=True))
+        for item in tasks:
+            item.expand = False
+
+        if len(tasks) == 1:
+            self.execute(tasks[0])
+            return
+
+        synclogger.info("Removing dir tree from server: target=%s, path=%s, files=%d, dirs=%d." % (self.name, remote, len(files), len(dirs) + 1))
+        self.queue.push_front(tasks)
+
+    def unlink(self, transport, remote):
+        """删除不知道是文件还是目录的路径，DELE返回永久错误（例如是目录）时返回False"""
+        try:
+            transport.delete(remote)
+        except error_perm as e:
+            synclogger.debug("Removing file from server failed, removing as dir: target=%s, path=%s, error=%s." % (self.name, remote, e))
+            return False
+
+        self.cache.removed(remote)
+        synclogger.info("Removed file from server: target=%s, path=%s." % (self.name, remote))
+        return True
+
+    def makedirs(self, transport, remote):
+        """创建服务器上缺失的各级目录，缓存中没有的目录直接执行MKD"""
+        path = ''
+        for name in remote.strip('/').split('/'):
+            if not name:
+                continue
+
+            path = path + '/' + name if path else name
+            if self.cache.lookup(path):
+                continue
+
+            if self.mkdir(transport, path):
+                synclogger.info("Created new dir in server: target=%s, path=%s." % (self.name, path))
+
+    def mkdir(self, transport, remote):
+        """创建目录，返回是否新创建，目录已经存在（MKD返回550等永久错误）时返回False"""
+        try:
+            transport.mkdir(remote)
+        except Exception as e:
+            if not Target.existing(e):
+                self.cache.invalidate(remote)
+                raise
+            # 其它传输线程可能同时创建了该目录
+            self.cache.added(remote, True, empty=False)
+            synclogger.debug("Created new dir in server failed, the dir exists: target=%s, path=%s, error=%s." % (self.name, remote, e))
+            return False
+
+        self.cache.added(remote, True)
+        return True
+
+    @staticmethod
+    def missing(error):
+        """命令是否因为路径不存在而失败：FTP服务器返回550，本地目录为ENOENT"""
+        if isinstance(error, (IOError, OSError)):
+            return error.errno == errno.ENOENT
+        return isinstance(error, error_perm) and str(error).startswith('550')
+
+    @staticmethod
+    def existing(error):
+        """MKD是否因为目录已经存在而失败：FTP服务器返回永久错误（550、521等），本地目录为EEXIST"""
+        if isinstance(error, (IOError, OSError)):
+            return error.errno == errno.EEXIST
+        return isinstance(error, error_perm)
+
+    def upload(self, transport, task):
+        """上传文件"""
+        remote = UploadFtp.path(task.pathname)
+        try:
+            st = os.stat(task.pathname)
+            if UploadFtp.oversize(task.pathname, st.st_size):
+                synclogger.info("Ignore file larger than FILTER_MAX_SIZE: path=%s, size=%d." % (task.pathname, st.st_size))
+                return
+
+            # 与上次上传的内容相同时跳过上传
+            digest = None
+            if DEDUPE and SyncIndex.conn is not None and not (DEDUPE_MAX_SIZE and st.st_size > DEDUPE_MAX_SIZE):
+                synced = SyncIndex.synced(self.name, task.pathname)
+                # 大小与上次上传时不同，内容一定有变化，只有服务器端复制需要先计算MD5
+                if DEDUPE_COPY or (synced is not None and synced[0] == st.st_size):
+                    digest = HashCache.get(task.pathname)
+                if digest is not None and synced == (st.st_size, digest) and self.cache.lookup(remote) is not False:
+                    SyncIndex.record(self.name, task.pathname, st.st_size, st.st_mtime, hash=digest)
+                    Metrics.inc('sync_dedupe_total', target=self.name, result='unchanged')
+                    Metrics.inc('sync_dedupe_skipped_bytes_total', st.st_size, target=self.name)
+                    synclogger.info("The file NOT changed, skipped: target=%s, local=%s, remote=%s." % (self.name, task.pathname, remote))
+                    return
+
+            # 没有目录缓存时，不检查上级目录是否存在，避免每次上传都执行MKD
+            if self.cache.size:
+                self.makedirs(transport, os.path.dirname(remote.rstrip('/')))
+
+            # 先上传为临时文件
+            if ATOMIC_UPLOAD:
+                dirname, name = os.path.split(remote)
+                temp = os.path.join(dirname, ATOMIC_TEMP_NAME % name)
+            else:
+                temp = remote
+
+            copied = DEDUPE_COPY and digest is not None and st.st_size > 0 and self.copy(transport, task, st, digest, temp)
+            if not copied:
+                if task.snapshot is not None:
+                    fp, loaded = task.snapshot.open(st)
+                    # 记录实际上传的内容的MD5
+                    if loaded is not None:
+                        digest = loaded
+                else:
+                    fp = open(task.pathname, 'rb')
+
+                try:
+                    istext = False
+                    if TRANSFER_MODE == 'auto':
+                        istext = UploadFtp.istext(fp.read(512))
+                        fp.seek(0)
+
+                    # 下次上传时可以使用增量传输的文件，上传的同时计算校验和，上传为临时文件时不能增量传输
+                    delta = TRANSFER_DELTA and temp == remote and (transport.resumable or transport.patchable) \
+                            and SyncIndex.conn is not None and st.st_size >= DELTA_MIN_SIZE
+                    # 上传前没有计算MD5时，记录实际发送的内容的MD5，上传完成后文件可能已经又被改写
+                    hashing = digest is None and SyncIndex.conn is not None \
+                            and (INDEX_HASH or (DEDUPE and not (DEDUPE_MAX_SIZE and st.st_size > DEDUPE_MAX_SIZE)))
+                    signer = None
+                    if delta or hashing:
+                        signer = fp = SigningFile(fp, DELTA_BLOCK_SIZE if delta else None, hashing)
+
+                    # 增量传输（追加上传或只写入有变化的数据块）没有发送的字节数
+                    skipped = 0
+                    sent = self.append(transport, task, fp, st, remote, istext) if delta else None
+                    if sent is not None:
+                        skipped = st.st_size - sent
+                    elif not istext and transport.resumable and RESUME_MIN_SIZE and st.st_size >= RESUME_MIN_SIZE:
+                        sent = self.upload_resumable(transport, task, fp, st, temp)
+                    else:
+                        signature = SyncIndex.signature(self.name, task.pathname) if delta and transport.patchable else None
+                        sent = transport.put(self.throttle(fp), temp, istext, signature)
+                        skipped = max(st.st_size - sent, 0)
+
+                    # 中断后续传时没有从头读取，不记录MD5
+                    if hashing:
+                        digest = signer.digest()
+
+                    # 记录上传的内容的校验和，下次上传时用于增量传输
+                    if delta:
+                        signature = signer.signature()
+                        if signature is None:
+                            # 中断后续传时没有从头读取，重新读取文件计算
+                            fp.seek(0)
+                            signature = BlockDelta.signature(fp, st.st_size)
+                        SyncIndex.sign(self.name, task.pathname, *signature)
+                finally:
+                    fp.close()
+
+            if temp != remote:
+                self.replace(transport, temp, remote)
+
+            SyncIndex.record(self.name, task.pathname, st.st_size, st.st_mtime, hash=digest)
+            self.cache.added(remote)
+            if copied:
+                Metrics.inc('sync_dedupe_total', target=self.name, result='copied')
+                Metrics.inc('sync_dedupe_skipped_bytes_total', st.st_size, target=self.name)
+                return
+
+            Metrics.inc('sync_uploaded_bytes_total', sent, target=self.name)
+            if skipped:
+                Metrics.inc('sync_delta_skipped_bytes_total', skipped, target=self.name)
+            synclogger.info("Uploaded %s file: target=%s, local=%s, remote=%s." % ('text' if istext else 'binary', self.name, task.pathname, remote))
+        except Exception as e:
+            self.cache.invalidate(remote)
+            synclogger.info("Uploaded file failed: target=%s, local=%s, remote=%s, error=%s." % (self.name, task.pathname, remote, e))
+            # 本地文件已经不存在时不需要重试，之后的删除或重命名事件会同步到服务器
+            if not (isinstance(e, (IOError, OSError)) and e.errno == errno.ENOENT):
+                self.retry(task, e)
+
+    def throttle(self, fp):
+        """需要限速时，返回按照全局和该服务器的限速读取的文件对象"""
+        limits = [limit for limit in (Transfer.limit, self.limit) if limit.rate]
+        return ThrottledFile(fp, limits) if limits else fp
+
+    def copy(self, transport, task, st, digest, remote):
+        """服务器上已经有内容相同的其它文件时，使用服务器端复制代替上传，返回是否复制成功"""
+        source = SyncIndex.find(self.name, st.st_size, digest, task.pathname)
+        if source is None:
+            return False
+
+        source = UploadFtp.path(source)
+        try:
+            transport.copy(source, remote)
+        except NotImplementedError:
+            return False
+        except Exception as e:
+            self.cache.invalidate(remote)
+            synclogger.debug("Copying file in server failed, uploading instead: target=%s, from=%s, to=%s, error=%s." % (self.name, source, remote, e))
+            return False
+
+        synclogger.info("Copied file in server: target=%s, local=%s, from=%s, to=%s." % (self.name, task.pathname, source, remote))
+        return True
+
+    def append(self, transport, task, fp, st, remote, istext=False):
+        """只在末尾追加了内容的文件，只上传（APPE）追加的内容，返回发送的字节数，不能追加时返回None
+
+        服务器上的文件大小等于上次上传的大小，并且本地文件的这部分内容与上次上传时的校验和相同时，
+        服务器上的内容才可以继续使用。
+        """
+        if not transport.resumable:
+            return None
+
+        signature = SyncIndex.signature(self.name, task.pathname)
+        if signature is None or signature[0] >= st.st_size:
+            return None
+
+        size, sums = signature
+        matched = BlockDelta.signature(fp, size) == signature and transport.stat(remote) == size
+        if not matched:
+            fp.seek(0)
+            return None
+
+        # 直接使用ftplib的连接，中断后由重试队列重新上传整个文件，而不是由mgftp重复追加
+        if istext:
+            transport.ftp.storlines("APPE " + remote, self.throttle(fp))
+        else:
+            mgftp.send(transport.ftp, "APPE " + remote, self.throttle(fp), TRANSFER_BLOCK_SIZE)
+
+        synclogger.info("Appended to file in server: target=%s, remote=%s, offset=%d, size=%d." % (self.name, remote, size, st.st_size))
+        return st.st_size - size
+
+    def retry(self, task, error):
+        """任务执行失败，加入重试队列"""
+        if task.failed:
+            return
+        task.failed = True
+        RetrySpool.add(self.name, task, error)
+
+    def alive(self):
+        """检查当前线程到服务器的连接是否正常，断开时尝试重新连接"""
+        try:
+            transport = self.connect()
+            if transport.is_alive():
+                return True
+            return transport.reconnect() and transport.is_alive()
+        except Exception as e:
+            synclogger.debug("Checking server failed: target=%s, error=%s." % (self.name, e))
+            return False
+
+    def replace(self, transport, temp, remote):
+        """把上传完成的临时文件重命名为正式的文件名"""
+        try:
+            transport.rename(temp, remote)
+        except error_perm as e:
+            # 有的FTP服务器不允许重命名为已经存在的文件（返回550等永久错误），
+            # 只有确认服务器上有旧文件时才删除旧文件后重试，其它错误保留旧文件，由重试队列重新上传
+            if not str(e).startswith('55'):
+                raise
+            self.cache.invalidate(remote)
+            found = self.cache.lookup(remote)
+            if found is None:
+                found = transport.stat(remote) is not None
+            if not found:
+                raise
+            synclogger.debug("Renamed temp file failed, remove the old file and retry: target=%s, remote=%s, error=%s." % (self.name, remote, e))
+            transport.delete(remote)
+            transport.rename(temp, remote)
+
+    def upload_resumable(self, transport, task, fp, st, remote):
+        """断点续传：从已经确认发送的位置继续上传，中断后最多续传RESUME_RETRIES次，返回发送的字节数"""
+        # 只有上次未完成的上传是同一个版本的文件时，才可以从记录的进度继续上传；
+        # 没有发送过数据时，服务器上可能还是旧版本的文件（STOR之前就断开了连接），不能按照SIZE续传
+        partial = SyncIndex.partial(self.name, task.pathname)
+        saved = partial[2] if partial is not None and partial[0] == st.st_size and partial[1] == st.st_mtime else 0
+
+        progress = {'offset': 0, 'saved': 0}
+        def callback(size):
+            progress['offset'] += size
+            # 每上传RESUME_MIN_SIZE字节记录一次进度
+            if progress['offset'] - progress['saved'] >= RESUME_MIN_SIZE:
+                progress['saved'] = progress['offset']
+                SyncIndex.progress(self.name, task.pathname, st.st_size, st.st_mtime, progress['offset'])
+
+        attempt = 0
+        while True:
+            offset = 0
+            if saved > 0:
+                # 服务器上的文件可能比记录的进度短（数据还没有写入磁盘），不能超过记录的进度
+                offset = min(transport.stat(remote) or 0, saved, st.st_size)
+
+            try:
+                fp.seek(offset)
+                progress['offset'] = progress['saved'] = offset
+                # 直接使用ftplib的连接，中断后由这里续传，而不是由mgftp从头重新上传
+                if offset and RESUME_COMMAND == 'APPE':
+                    mgftp.send(transport.ftp, "APPE " + remote, self.throttle(fp), TRANSFER_BLOCK_SIZE, callback)
+                else:
+                    mgftp.send(transport.ftp, "STOR " + remote, self.throttle(fp), TRANSFER_BLOCK_SIZE, callback, offset or None)
+
+                if offset:
+                    synclogger.info("Resumed uploading file: target=%s, remote=%s, offset=%d, size=%d." % (self.name, remote, offset, st.st_size))
+                break
+            except Exception as e:
+                # 只记录已经发送的进度，没有发送数据时下次从头上传
+                saved = progress['offset']
+                if saved > 0:
+                    SyncIndex.progress(self.name, task.pathname, st.st_size, st.st_mtime, saved)
+                else:
+                    SyncIndex.finish(self.name, task.pathname)
+
+                attempt += 1
+                if attempt > RESUME_RETRIES:
+                    raise
+
+                synclogger.warning("Uploading file interrupted, resuming: target=%s, remote=%s, offset=%d, error=%s." % (self.name, remote, saved, e))
+                transport.reconnect()
+
+        SyncIndex.finish(self.name, task.pathname)
+        return st.st_size - offset
+
+class RetrySpool():
+    """执行失败的任务，按指数退避（带随机抖动）重试
+
+    重试队列保存在索引文件中（没有索引文件时保存在内存中），服务器连接恢复后立即重试。
+    超过重试次数、或者服务器返回永久错误（5xx）的任务写入死信文件。
+    """
+
+    conn = None
+    lock = threading.Lock()
+    worker = None
+    count = 0
+    # 连接中断的目标服务器
+    down = set()
+
+    @staticmethod
+    def open():
+        """创建重试队列的数据表"""
+        if SyncIndex.conn is not None:
+            conn = SyncIndex.conn
+            RetrySpool.lock = SyncIndex.lock
+        else:
+            conn = sqlite3.connect(':memory:', check_same_thread=False)
+            conn.text_factory = str
+
+        with RetrySpool.lock:
+            conn.execute('''CREATE TABLE IF NOT EXISTS retries (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                target TEXT NOT NULL,
+                                op TEXT NOT NULL,
+                                path TEXT NOT NULL,
+                                src_path TEXT,
+                                isdir INTEGER NOT NULL DEFAULT 0,
+                                attempts INTEGER NOT NULL,
+                                next_time REAL NOT NULL,
+                                error TEXT)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS retries_path ON retries (target, path)')
+            conn.commit()
+            RetrySpool.count = conn.execute('SELECT COUNT(*) FROM retries').fetchone()[0]
+
+        RetrySpool.conn = conn
+        if RetrySpool.count:
+            synclogger.info('Found failed tasks to retry: count=%d.' % (RetrySpool.count))
+
+    @staticmethod
+    def execute(sql, args=()):
+        with RetrySpool.lock:
+            try:
+                cursor = RetrySpool.conn.execute(sql, args)
+                rows = cursor.fetchall()
+                RetrySpool.conn.commit()
+                # 按照插入、删除的行数更新任务数量，不重新统计整个表
+                verb = sql.split()[0].upper()
+                if verb == 'INSERT':
+                    RetrySpool.count += cursor.rowcount
+                elif verb == 'DELETE':
+                    RetrySpool.count -= cursor.rowcount
+                return rows
+            except sqlite3.Error as e:
+                synclogger.error('Updating retry spool failed: sql=%s, error=%s.' % (sql.split()[0], e))
+                return []
+
+    @staticmethod
+    def delay(attempts):
+        """第attempts次重试前的等待时间（秒），取指数退避时间的一半加上随机的另一半"""
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    @staticmethod
+    def add(target, task, error):
+        """加入重试队列，超过重试次数时写入死信文件"""
+        attempts = task.attempts + 1
+        if attempts > RETRY_MAX_ATTEMPTS:
+            RetrySpool.dead(target, task, error)
+            return
+        # 永久错误（例如没有权限、文件名不合法）重试也不会成功
+        if isinstance(error, error_perm):
+            RetrySpool.dead(target, task, error)
+            return
+        if RetrySpool.count >= RETRY_SPOOL_SIZE:
+            RetrySpool.dead(target, task, 'the retry spool is full, last error: %s' % (error))
+            return
+
+        # 同一文件只保留最后一次上传或删除
+        if task.op in ('upload', 'delete'):
+            RetrySpool.execute("DELETE FROM retries WHERE target = ? AND path = ? AND op IN ('upload', 'delete')", (target, task.pathname))
+
+        delay = RetrySpool.delay(attempts)
+        RetrySpool.execute('INSERT INTO retries (target, op, path, src_path, isdir, attempts, next_time, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (target, task.op, task.pathname, task.src_pathname, int(task.isdir), attempts, time.time() + delay, str(error)))
+        Metrics.inc('sync_retry_spooled_total', target=target)
+        synclogger.info("Spooled failed task to retry: target=%s, op=%s, path=%s, attempts=%d, delay=%.1f." % (target, task.op, task.pathname, attempts, delay))
+
+    @staticmethod
+    def persist(target, tasks, error='daemon stopped'):
+        """保存没有执行的任务（例如守护进程停止时），尽快执行，不计入重试次数"""
+        for task in tasks:
+            if task.op in ('upload', 'delete'):
+                RetrySpool.execute("DELETE FROM retries WHERE target = ? AND path = ? AND op IN ('upload', 'delete')", (target, task.pathname))
+            RetrySpool.execute('INSERT INTO retries (target, op, path, src_path, isdir, attempts, next_time, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (target, task.op, task.pathname, task.src_pathname, int(task.isdir), task.attempts, time.time(), error))
+
+    @staticmethod
+    def succeeded(target, task):
+        """任务执行成功，之前失败的同一路径上的任务不需要再重试了
+
+        删除目录成功时，目录下之前失败的除了上传以外的任务也不再重试，
+        上传总是读取本地当前的文件内容，重试不会覆盖更新的内容。
+        """
+        if not RetrySpool.count:
+            return
+
+        path = task.pathname.rstrip('/')
+        RetrySpool.execute('DELETE FROM retries WHERE target = ? AND path = ?', (target, path))
+        if task.op in ('rmd', 'rmtree'):
+            RetrySpool.execute("DELETE FROM retries WHERE target = ? AND substr(path, 1, ?) = ? AND op != 'upload'", (target, len(path) + 1, path + '/'))
+
+    @staticmethod
+    def outdated(task):
+        """重试前检查本地的状态，任务已经过时时返回True，需要时把任务改为删除原来的路径"""
+        if task.op in ('rmd', 'rmtree'):
+            # 目录又被创建了
+            return os.path.isdir(task.pathname)
+        if task.op == 'delete':
+            return os.path.lexists(task.pathname)
+        if task.op == 'mkd':
+            return not os.path.isdir(task.pathname)
+        if task.op == 'rename' and not os.path.lexists(task.pathname):
+            # 目标路径已经不存在，原来的路径也不存在时，从服务器上删除原来的路径
+            if os.path.lexists(task.src_pathname):
+                return True
+            task.op = 'rmtree' if task.isdir else 'delete'
+            task.pathname, task.src_pathname = task.src_pathname, None
+        return False
+
+    @staticmethod
+    def dead(target, task, error):
+        """写入死信文件，不再重试"""
+        Metrics.inc('sync_retry_dead_total', target=target)
+        synclogger.error("Gave up retrying task: target=%s, op=%s, path=%s, attempts=%d, error=%s." % (target, task.op, task.pathname, task.attempts, error))
+        if not RETRY_DEAD_LETTER_FILE:
+            return
+
+        line = json.dumps({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'target': target, 'op': task.op, 'path': task.pathname,
+                           'src_path': task.src_pathname, 'isdir': bool(task.isdir), 'attempts': task.attempts, 'error': str(error)})
+        try:
+            with open(RETRY_DEAD_LETTER_FILE, 'a') as fp:
+                fp.write(line + '\n')
+        except IOError as e:
+            synclogger.error("Writing dead letter failed: path=%s, error=%s." % (RETRY_DEAD_LETTER_FILE, e))
+
+    @staticmethod
+    def start():
+        """启动重试线程"""
+        if RetrySpool.conn is None:
+            RetrySpool.open()
+        if RETRY_MAX_ATTEMPTS <= 0 or RetrySpool.worker is not None:
+            return
+
+        RetrySpool.worker = threading.Thread(target=RetrySpool.loop, name='retry')
+        RetrySpool.worker.daemon = True
+        RetrySpool.worker.start()
+
+    @staticmethod
+    def loop():
+        while True:
+            time.sleep(RETRY_CHECK_INTERVAL)
+            if not RetrySpool.count:
+                continue
+
+            for target in Transfer.targets:
+                try:
+                    RetrySpool.replay(target)
+                except Exception as e:
+                    synclogger.error("Retrying failed tasks failed: target=%s, error=%s." % (target.name, e))
+
+    @staticmethod
+    def replay(target):
+        """服务器连接正常时，把到期的任务重新加入上传队列；连接恢复时重试所有任务"""
+        down = target.name in RetrySpool.down
+        if down:
+            rows = RetrySpool.execute('SELECT id, op, path, src_path, isdir, attempts FROM retries WHERE target = ? ORDER BY id', (target.name, ))
+        else:
+            rows = RetrySpool.execute('SELECT id, op, path, src_path, isdir, attempts FROM retries WHERE target = ? AND next_time <= ? ORDER BY id', (target.name, time.time()))
+        if not rows:
+            return
+
+        if not target.alive():
+            if not down:
+                RetrySpool.down.add(target.name)
+                synclogger.error("The ftp server is down, retrying paused: target=%s, count=%d." % (target.name, RetrySpool.count))
+            return
+        if down:
+            RetrySpool.down.discard(target.name)
+            synclogger.info("The ftp server is recovered, retrying all failed tasks: target=%s, count=%d." % (target.name, len(rows)))
+
+        for id, op, path, src_path, isdir, attempts in rows:
+            RetrySpool.execute('DELETE FROM retries WHERE id = ?', (id, ))
+            task = SyncTask(op, path, src_path, bool(isdir))
+            task.attempts = attempts
+            if RetrySpool.outdated(task):
+                synclogger.info("Skipped outdated failed task: target=%s, op=%s, path=%s." % (target.name, op, path))
+                continue
+            synclogger.debug("Retrying failed task: target=%s, op=%s, path=%s, attempts=%d." % (target.name, op, path, attempts))
+            target.put(task, wait=True)
+
+class Transfer():
+    """把任务分发给所有的目标服务器"""
+
+    targets = []
+    # 所有服务器共享的限速
+    limit = RateLimit(TRANSFER_RATE_LIMIT, 'global')
+
+    @staticmethod
+    def start():
+        """创建目标服务器并启动传输线程池"""
+        if not Transfer.targets:
+            for config in UPLOAD_TARGETS:
+                Transfer.targets.append(Target(config))
+
+        for target in Transfer.targets:
+            target.start()
+
+    @staticmethod
+    def reload():
+        """按照新的UPLOAD_TARGETS更新目标服务器，返回新增的目标服务器
+
+        配置有变化的服务器重新连接；删除的服务器不再加入新的任务，已经在上传队列中的任务仍然会执行。
+        """
+        targets = collections.OrderedDict((target.name, target) for target in Transfer.targets)
+        added = []
+        result = []
+        for config in UPLOAD_TARGETS:
+            target = targets.pop(config['name'], None)
+            if target is None:
+                target = Target(config)
+                added.append(target)
+                synclogger.info('Added target: target=%s, transport=%s.' % (target.name, config['transport']))
+            elif target.config != config:
+                target.reconfigure(config)
+            target.start()
+            result.append(target)
+
+        for target in targets.values():
+            synclogger.info('Removed target: target=%s, queued=%d.' % (target.name, target.queue.qsize()))
+
+        Transfer.targets = result
+        return added
+
+    @staticmethod
+    def route(path):
+        """路径所在的监视路径同步到的目标服务器"""
+        root = WatchRoots.lookup(path)
+        if root is None:
+            return []
+        if root.targets is None:
+            return list(Transfer.targets)
+        return [target for target in Transfer.targets if target.name in root.targets]
+
+    @staticmethod
+    def put(task):
+        """加入路径所在的监视路径的所有目标服务器的上传队列"""
+        targets = Transfer.route(task.pathname)
+        # 只分类一次，所有服务器使用相同的优先级
+        task.priority, task.klass = Priority.classify(task)
+        snapshot = None
+        if task.op == 'upload' and len(targets) > 1:
+            snapshot = FileSnapshot(task.pathname, len(targets))
+
+        # 同步到多个服务器时，上传队列已满的服务器不等待，任务保存到该服务器的重试队列（不能保存时重新扫描所在的目录），
+        # 较慢的服务器不会阻塞合并线程，其它服务器的上传队列继续加入任务
+        block = len(targets) <= 1
+        queued = False
+        for target in targets:
+            item = copy.copy(task)
+            item.snapshot = snapshot
+            if target.put(item, block=block):
+                queued = True
+
+        return queued
+
+class Coalescer():
+    """合并短时间内同一路径上的多次变化，路径稳定COALESCE_WINDOW秒后才加入上传队列
+
+    合并规则：
+    * 多次写入只上传一次；
+    * 新建后又删除的文件或目录，不做任何操作；
+    * 写入后重命名的文件，直接上传为新的文件名；
+    * 其它无法合并的操作，先把之前的操作加入上传队列，保证执行顺序。
+    """
+
+    pending = collections.OrderedDict()
+    cond = threading.Condition()
+    worker = None
+
+    @staticmethod
+    def start():
+        """启动合并线程"""
+        if COALESCE_WINDOW > 0 and Coalescer.worker is None:
+            Coalescer.worker = threading.Thread(target=Coalescer.loop, name='coalescer')
+            Coalescer.worker.daemon = True
+            Coalescer.worker.start()
+            synclogger.debug("Started coalescer thread: window=%s, max_delay=%s." % (COALESCE_WINDOW, COALESCE_MAX_DELAY))
+
+    @staticmethod
+    def put(task):
+        """加入一次变化，没有开启合并功能时直接加入上传队列"""
+        if COALESCE_WINDOW <= 0:
+            if task.op == 'create':
+                return True
+            return Transfer.put(task)
+
+        with Coalescer.cond:
+            Coalescer.merge(task)
+            Coalescer.cond.notify_all()
+        return True
+
+    @staticmethod
+    def key(path):
+        return path.rstrip('/')
+
+    @staticmethod
+    def add(task):
+        task.updated = time.time()
+        Coalescer.pending[Coalescer.key(task.pathname)] = task
+
+    @staticmethod
+    def emit(key):
+        """把等待合并的操作加入上传队列，上级目录上等待合并的操作（例如创建目录）先加入"""
+        for path in Coalescer.pending[key].paths():
+            for parent in parent_paths(path):
+                if parent in Coalescer.pending:
+                    Coalescer.emit(parent)
+
+        task = Coalescer.pending.pop(key)
+        if task.op != 'create':
+            Transfer.put(task)
+
+    @staticmethod
+    def children(key):
+        """等待合并的、位于目录key下的路径"""
+        prefix = key + '/'
+        return [k for k in Coalescer.pending if k.startswith(prefix)]
+
+    @staticmethod
+    def rebase(task, src, dst):
+        """目录重命名后，修改任务中的路径"""
+        task.pathname = dst + task.pathname[len(src):]
+        if task.src_pathname and task.src_pathname.startswith(src + '/'):
+            task.src_pathname = dst + task.src_pathname[len(src):]
+        return task
+
+    @staticmethod
+    def merge(task):
+        key = Coalescer.key(task.pathname)
+        last = Coalescer.pending.get(key)
+
+        if task.op == 'create':
+            if last is None:
+                task.fresh = True
+                Coalescer.add(task)
+            else:
+                last.updated = time.time()
+        elif task.op == 'upload':
+            if last is None:
+                Coalescer.add(task)
+            elif last.op in ('create', 'upload', 'delete'):
+                if last.op == 'delete':
+                    last.fresh = False
+                last.op = 'upload'
+                last.updated = time.time()
+                synclogger.debug("Coalesced upload: path=%s." % (task.pathname))
+            else:
+                Coalescer.emit(key)
+                Coalescer.add(task)
+        elif task.op == 'delete':
+            if last is None:
+                Coalescer.add(task)
+            elif last.op in ('create', 'upload') and last.fresh:
+                del Coalescer.pending[key]
+                synclogger.debug("Coalesced created and deleted file, skipped: path=%s." % (task.pathname))
+            elif last.op in ('create', 'upload', 'delete'):
+                last.op = 'delete'
+                last.updated = time.time()
+            else:
+                Coalescer.emit(key)
+                Coalescer.add(task)
+        elif task.op == 'mkd':
+            if last is not None and last.op == 'mkd':
+                last.updated = time.time()
+            else:
+                if last is not None:
+                    Coalescer.emit(key)
+                task.fresh = True
+                Coalescer.add(task)
+        elif task.op == 'rmd':
+            if last is not None and last.op == 'mkd' and last.fresh:
+                # 新建的目录还没有创建，其下的操作也都还没有执行（参考emit），都不需要执行了，
+                # 从目录以外移入的文件或目录，从服务器上删除原来的路径
+                del Coalescer.pending[key]
+                for child in Coalescer.children(key):
+                    item = Coalescer.pending.pop(child)
+                    if item.src_pathname and not Coalescer.key(item.src_pathname).startswith(key + '/'):
+                        Transfer.put(SyncTask('rmtree' if item.isdir else 'delete', item.src_pathname, isdir=item.isdir))
+                synclogger.debug("Coalesced created and removed dir, skipped: path=%s." % (task.pathname))
+            else:
+                if last is not None:
+                    Coalescer.emit(key)
+
+                # 目录下等待执行的操作，都由删除整个目录树代替：先执行RMD，目录不为空时再读取目录树删除
+                folded = 0
+                for child in Coalescer.children(key):
+                    item = Coalescer.pending[child]
+                    if item.src_pathname and not Coalescer.key(item.src_pathname).startswith(key + '/'):
+                        Coalescer.emit(child)
+                    else:
+                        del Coalescer.pending[child]
+                        folded += 1
+
+                Coalescer.add(task)
+                synclogger.debug("Coalesced removed dir into dir tree removal: path=%s, folded=%d." % (task.pathname, folded))
+        elif task.op == 'rename' and task.src_pathname:
+            src_key = Coalescer.key(task.src_pathname)
+            source = Coalescer.pending.get(src_key)
+
+            if last is not None:
+                Coalescer.emit(key)
+
+            if not task.isdir and source is not None and source.op in ('create', 'upload'):
+                # 写入后重命名，直接上传为新的文件名
+                del Coalescer.pending[src_key]
+                if not source.fresh:
+                    Coalescer.add(SyncTask('delete', task.src_pathname))
+                Coalescer.add(SyncTask('upload', task.pathname, fresh=source.fresh))
+                synclogger.debug("Coalesced renamed file into upload: from=%s, to=%s." % (task.src_pathname, task.pathname))
+            elif task.isdir and source is not None and source.op == 'mkd' and source.fresh:
+                # 新建后重命名的目录，直接创建为新的目录名
+                del Coalescer.pending[src_key]
+                Coalescer.add(SyncTask('mkd', task.pathname, isdir=True, fresh=True))
+                for child in Coalescer.children(src_key):
+                    Coalescer.add(Coalescer.rebase(Coalescer.pending.pop(child), src_key, key))
+                synclogger.debug("Coalesced renamed dir into mkdir: from=%s, to=%s." % (task.src_pathname, task.pathname))
+            else:
+                if source is not None:
+                    Coalescer.emit(src_key)
+
+                moved = []
+                if task.isdir:
+                    # 目录下等待上传的文件在重命名之后上传到新的路径，其它操作在重命名之前执行
+                    for child in Coalescer.children(src_key):
+                        if Coalescer.pending[child].op in ('create', 'upload'):
+                            moved.append(Coalescer.rebase(Coalescer.pending.pop(child), src_key, key))
+                        else:
+                            Coalescer.emit(child)
+
+                Coalescer.add(task)
+                for child in moved:
+                    Coalescer.add(child)
+        else:
+            if last is not None:
+                Coalescer.emit(key)
+            Coalescer.add(task)
+
+    @staticmethod
+    def loop():
+        while True:
+            with Coalescer.cond:
+                timeout = Coalescer.flush()
+                Coalescer.cond.wait(timeout)
+
+    @staticmethod
+    def drain():
+        """守护进程停止时，把所有等待合并的操作按顺序加入上传队列"""
+        with Coalescer.cond:
+            for key in list(Coalescer.pending):
+                Coalescer.emit(key)
+
+    @staticmethod
+    def flush():
+        """把已经稳定的操作加入上传队列，返回下次检查前需要等待的时间"""
+        now = time.time()
+        timeout = COALESCE_WINDOW
+        locks = PathLocks()
+
+        for key, task in Coalescer.pending.items():
+            settled = now - task.updated >= COALESCE_WINDOW or now - task.created >= COALESCE_MAX_DELAY
+
+            if settled and task.op == 'create':
+                # 只创建没有写入的文件，等待IN_CLOSE_WRITE事件
+                del Coalescer.pending[key]
+            elif settled and not locks.conflict(task):
+                del Coalescer.pending[key]
+                Transfer.put(task)
+            else:
+                locks.add(task)
+                if not settled:
+                    timeout = min(timeout, task.updated + COALESCE_WINDOW - now, task.created + COALESCE_MAX_DELAY - now)
+
+        return max(timeout, 0.05)
+
+class Rescanner():
+    """丢失事件后，重新扫描受影响的目录树
+
+    与索引比较，只同步有变化的路径，并把没有监视的目录加入监视。
+    新建或移入的目录树也在这里遍历上传，不阻塞事件处理线程。
+    """
+
+    pending = set()
+    # 等待遍历上传的新目录树：[(路径, 监视描述符), ...]
+    trees = []
+    cond = threading.Condition()
+    worker = None
+
+    @staticmethod
+    def start():
+        if Rescanner.worker is None:
+            Rescanner.worker = threading.Thread(target=Rescanner.loop, name='rescan')
+            Rescanner.worker.daemon = True
+            Rescanner.worker.start()
+
+    @staticmethod
+    def put(path, reason):
+        """加入需要重新扫描的目录"""
+        path = path.rstrip('/') or '/'
+        Metrics.inc('sync_rescans_total', reason=reason)
+        synclogger.warning("Rescan dir tree for lost changes: path=%s, reason=%s." % (path, reason))
+        with Rescanner.cond:
+            Rescanner.pending.add(path)
+            Rescanner.cond.notify()
+
+    @staticmethod
+    def sync(pathname, wd):
+        """加入需要遍历上传的新目录树，wd为目录加入监视时的描述符"""
+        with Rescanner.cond:
+            Rescanner.trees.append((pathname, wd))
+            Rescanner.cond.notify()
+
+    @staticmethod
+    def loop():
+        while True:
+            with Rescanner.cond:
+                while not Rescanner.pending and not Rescanner.trees:
+                    Rescanner.cond.wait()
+                trees = Rescanner.trees
+                Rescanner.trees = []
+
+            # 新目录树按事件的顺序立即遍历，不需要等待
+            for pathname, wd in trees:
+                try:
+                    Rescanner.sync_tree(pathname, wd)
+                except Exception as e:
+                    synclogger.error("Syncing new dir tree failed: path=%s, error=%s." % (pathname, e))
+
+            with Rescanner.cond:
+                if not Rescanner.pending:
+                    continue
+
+            # 合并短时间内的多次重新扫描
+            time.sleep(RESCAN_DELAY)
+            with Rescanner.cond:
+                paths = sorted(Rescanner.pending)
+                Rescanner.pending.clear()
+
+            # 上级目录已经需要扫描时，不再单独扫描子目录
+            roots = []
+            for path in paths:
+                if not [root for root in roots if path == root or path.startswith(root.rstrip('/') + '/')]:
+                    roots.append(path)
+
+            for root in roots:
+                try:
+                    Rescanner.rescan(root)
+                except Exception as e:
+                    synclogger.error("Rescanning dir tree failed: path=%s, error=%s." % (root, e))
+
+    @staticmethod
+    def rescan(root):
+        # 目录已经不存在时，扫描其上级目录
+        top = WatchRoots.lookup(root)
+        if top is None:
+            return
+        top = top.path.rstrip('/') or '/'
+        while not os.path.isdir(root) and root.startswith(top + '/'):
+            root = os.path.dirname(root)
+
+        started = time.time()
+        watched = set(watch.path.rstrip('/') for watch in wm.watches.values())
+        added = 0
+        for dirname in walk_dirs(root, UploadFtp.exclude_dir):
+            if dirname not in watched and wm.add_watch(dirname, mask, rec=False).get(dirname, -1) >= 0:
+                added += 1
+
+        if SyncIndex.conn is None:
+            synclogger.warning("No index file, upload all files in dir tree: path=%s." % (root))
+        reconcile(root, RESCAN_DELETE)
+        synclogger.info("Rescanned dir tree: path=%s, watched=%d, seconds=%.2f." % (root, added, time.time() - started))
+
+    @staticmethod
+    def sync_tree(pathname, wd):
+        """上传目录下的所有子目录和文件，目录本身已经由事件处理线程创建"""
+        # 遍历之前目录可能已经被重命名（监视路径已经更新），或者已经被删除、移出
+        watch = wm.watches.get(wd)
+        if watch is None:
+            return
+        pathname = watch.path
+
+        dirs = files = 0
+        failed = []
+        for path, isdir, st in walk_tree(pathname, UploadFtp.exclude_dir, failed):
+            if UploadFtp.ignore(path, isdir):
+                continue
+
+            if isdir:
+                Coalescer.put(SyncTask('mkd', path, isdir=True))
+                dirs += 1
+            elif stat.S_ISREG(st.st_mode) and not UploadFtp.oversize(path, st.st_size):
+                Coalescer.put(SyncTask('upload', path))
+                files += 1
+
+        if dirs or files:
+            synclogger.info("Found dir tree to sync: path=%s, dirs=%d, files=%d." % (pathname, dirs, files))
+
+        # 遍历时子目录被重命名或者无法读取，重新扫描其上级目录
+        for path in failed:
+            if path != pathname:
+                Rescanner.put(os.path.dirname(path), 'listing failed')
+
+class EventHandler(pyinotify.ProcessEvent):
+    """针对各种磁盘操作的响应方法，FTP操作交给传输线程执行"""
+
+    def my_init(self):
+        # 等待配对的移出事件：{cookie: (event, 时间)}
+        self.moves = collections.OrderedDict()
+
+    def __call__(self, event):
+        # 移出和移入事件是连续的，其它事件到达时，之前没有配对的移出事件都不会再配对了
+        if self.moves and not event.mask & pyinotify.IN_MOVED_TO:
+            self.expire_moves(force=True)
+        return pyinotify.ProcessEvent.__call__(self, event)
+
+    @Metrics.measure('sync_event', event='IN_CLOSE_WRITE')
+    def process_IN_CLOSE_WRITE(self, event):
+        # check ingore
+        if UploadFtp.ignore(event.pathname, event.mask & pyinotify.IN_ISDIR):
+            synclogger.info("Ignore file: path=%s." % (event.pathname))
+            return None
+
+        synclogger.debug("Wrote file success: path=%s." % (event.pathname))
+
+        Coalescer.put(SyncTask('upload', event.pathname))
+
+    @Metrics.measure('sync_event', event='IN_DELETE')
+    def process_IN_DELETE(self, event):
+        # check ingore
+        if UploadFtp.ignore(event.pathname, event.mask & pyinotify.IN_ISDIR):
+            synclogger.info("Ignore file: path=%s." % (event.pathname))
+            return None
+
+        if event.mask & pyinotify.IN_ISDIR:
+            # 被删除的目录，内核会自动去掉对它的监视（IN_IGNORED）
+            synclogger.debug("Removed dir: path=%s." % (event.pathname))
+
+            Coalescer.put(SyncTask('rmd', event.pathname, isdir=True))
         else:
             synclogger.debug("Removed file: path=%s." % (event.pathname))
-            try:
-                ftp.delete(UploadFtp.path(event.pathname))
-                synclogger.info("Removed file from server: path=%s." % (UploadFtp.path(event.pathname)))
-            except Exception as e:
-                synclogger.error("Removing file from server failed: path=%s, error=%s." % (UploadFtp.path(event.pathname), e))
 
-    def process_IN_CREATE(self, event):
-        ftp = UploadFtp.connect()
+            Coalescer.put(SyncTask('delete', event.pathname))
 
+    @Metrics.measure('sync_event', event='IN_CREATE')
+    def process_IN_CREATE(self, event):
         # check ingore
-        if UploadFtp.ignore(event.pathname):
+        if UploadFtp.ignore(event.pathname, event.mask & pyinotify.IN_ISDIR):
             synclogger.info("Ignore file: path=%s." % (event.pathname))
             return None
 
         if event.mask & pyinotify.IN_ISDIR:
             synclogger.debug("Created new dir: path=%s." % (event.pathname))
 
-            try:
-                wm.add_watch(event.pathname, mask, rec=True)
-                synclogger.debug("Add new dir to watch list: path=%s." % (event.pathname))
-            except Exception as e:
-                synclogger.error("Add new dir to watch list failed: path=%s, error=%s." % (event.pathname, e))
+            wd = self.watch(event.pathname)
 
-            try:
-                ftp.mkd(UploadFtp.path(event.pathname))
-                synclogger.info("Created new dir in server: path=%s." % (UploadFtp.path(event.pathname)))
-            except Exception as e:
-                synclogger.error("Created new dir in server failed: path=%s, error=%s." % (UploadFtp.path(event.pathname), e))
+            # 例如mkdir -p或者解压缩，在加入监视之前目录中可能已经有内容了，由后台线程遍历上传
+            self.sync_tree(event.pathname, wd)
+        else:
+            synclogger.debug("Created new file: path=%s." % (event.pathname))
+
+            Coalescer.put(SyncTask('create', event.pathname))
 
+    @Metrics.measure('sync_event', event='IN_MOVED_FROM')
+    def process_IN_MOVED_FROM(self, event):
+        # 等待相同cookie的移入事件，超时没有配对时认为移到了监视路径以外
+        synclogger.debug("Moved file or dir: path=%s, cookie=%d." % (event.pathname, event.cookie))
+        self.moves[event.cookie] = (event, time.time())
 
+    @Metrics.measure('sync_event', event='IN_MOVED_TO')
     def process_IN_MOVED_TO(self, event):
-        ftp = UploadFtp.connect()
+        isdir = event.mask & pyinotify.IN_ISDIR
+        source = self.moves.pop(event.cookie, (None, None))[0]
+
+        # 源路径不同步时（例如临时文件重命名为正式的文件名），当作移入处理
+        if source is not None and UploadFtp.ignore(source.pathname, isdir):
+            source = None
+
+        # 在不同的监视路径之间移动，服务器路径和目标服务器都可能不同，当作移出后再移入处理
+        if source is not None and WatchRoots.lookup(source.pathname) is not WatchRoots.lookup(event.pathname):
+            self.moved_out(source)
+            source = None
 
         # check ingore
-        if UploadFtp.ignore(event.pathname):
+        if UploadFtp.ignore(event.pathname, isdir):
             synclogger.info("Ignore file: path=%s." % (event.pathname))
+            # 移动为不同步的路径，当作移出处理
+            if source is not None:
+                self.moved_out(source)
             return None
 
+        if source is None:
+            # 从监视路径以外移入的文件或目录，直接上传
+            if isdir:
+                synclogger.debug("Moved in dir: path=%s." % (event.pathname))
+
+                wd = self.watch(event.pathname)
+                self.sync_tree(event.pathname, wd)
+            else:
+                synclogger.debug("Moved in file: path=%s." % (event.pathname))
+
+                Coalescer.put(SyncTask('upload', event.pathname))
+        elif isdir:
+            synclogger.debug("Renamed dir: from=%s, to=%s." % (source.pathname, event.pathname))
+
+            # 目录及其子目录的监视仍然有效，只需要更新路径
+            self.rebase_watches(source.pathname, event.pathname)
+
+            Coalescer.put(SyncTask('rename', event.pathname, source.pathname, isdir=True))
+        else:
+            synclogger.debug("Renamed file: from=%s, to=%s." % (source.pathname, event.pathname))
+
+            Coalescer.put(SyncTask('rename', event.pathname, source.pathname))
+
+    def moved_out(self, event):
+        """文件或目录被移到了监视路径以外，从服务器上删除"""
+        if UploadFtp.ignore(event.pathname, event.mask & pyinotify.IN_ISDIR):
+            return
+
         if event.mask & pyinotify.IN_ISDIR:
-            synclogger.debug("Renamed dir: from=%s, to=%s." % (event.src_pathname, event.pathname))
+            synclogger.debug("Moved out dir: path=%s." % (event.pathname))
 
-            # 去掉对源目录的监测
-            try:
-                wm.rm_watch(event.src_pathname, rec=True)
-                synclogger.debug("Removed dir to watch list: path=%s." % (event.src_pathname))
-            except Exception as e:
-                synclogger.error("Removing dir to watch list failed: path=%s, error=%s." % (event.src_pathname, e))
+            # 移出的目录仍然存在，需要去掉对它及其子目录的监视
+            self.unwatch(event.pathname)
+            Coalescer.put(SyncTask('rmd', event.pathname, isdir=True))
+        else:
+            synclogger.debug("Moved out file: path=%s." % (event.pathname))
+
+            Coalescer.put(SyncTask('delete', event.pathname))
+
+    def expire_moves(self, notifier=None, force=False):
+        """没有配对的移出事件超时后，当作移出处理；force为True时处理所有等待配对的移出事件"""
+        now = time.time()
+        while self.moves:
+            cookie, (event, moved) = next(self.moves.iteritems())
+            if not force and now - moved < MOVE_PAIR_TIMEOUT:
+                break
+
+            del self.moves[cookie]
+            self.moved_out(event)
+
+    @staticmethod
+    def unwatch(pathname):
+        """去掉对目录及其子目录的监视"""
+        prefix = pathname.rstrip('/') + '/'
+        wds = [wd for wd, watch in wm.watches.items() if watch.path == pathname or watch.path.startswith(prefix)]
+        if wds:
+            wm.rm_watch(wds, quiet=True)
+            synclogger.debug("Removed dir from watch list: path=%s, count=%d." % (pathname, len(wds)))
+
+    @staticmethod
+    def rebase_watches(src_pathname, pathname):
+        """目录移动后，更新目录及其子目录的监视路径"""
+        prefix = src_pathname.rstrip('/') + '/'
+        for watch in wm.watches.values():
+            if watch.path == src_pathname:
+                watch.path = pathname
+            elif watch.path.startswith(prefix):
+                watch.path = os.path.join(pathname, watch.path[len(prefix):])
+
+    @Metrics.measure('sync_event', event='IN_Q_OVERFLOW')
+    def process_IN_Q_OVERFLOW(self, event):
+        # 无法知道丢失了哪些目录下的事件，重新扫描所有的监视路径
+        synclogger.error("The inotify event queue overflowed, some changes are lost, please increase fs.inotify.max_queued_events.")
+        for root in WatchRoots.all():
+            Rescanner.put(root.path, 'overflow')
+
+    def watch(self, pathname):
+        """把新的目录树加入监视，返回目录的监视描述符，加入失败的目录（例如刚创建就被删除）重新扫描其上级目录"""
+        try:
+            result = wm.add_watch(pathname, mask, rec=True, exclude_filter=UploadFtp.exclude_dir)
+            synclogger.debug("Add new dir to watch list: path=%s." % (pathname))
+        except Exception as e:
+            synclogger.error("Add new dir to watch list failed: path=%s, error=%s." % (pathname, e))
+            result = {pathname: -1}
+
+        for path, wd in result.items():
+            if wd < 0:
+                Rescanner.put(os.path.dirname(path.rstrip('/')), 'add_watch failed')
+
+        return result.get(pathname, -1)
+
+    def sync_tree(self, pathname, wd):
+        """在服务器上创建目录，目录下的所有子目录和文件由后台线程遍历上传"""
+        Coalescer.put(SyncTask('mkd', pathname, isdir=True))
+
+        # 加入监视失败时已经重新扫描上级目录
+        if wd >= 0:
+            Rescanner.sync(pathname, wd)
+
+def walk_dirs(root, exclude=None):
+    """遍历root下的所有目录（包括root），不跟随符号链接，exclude返回True的目录及其子目录不会遍历"""
+    stack = [root.rstrip('/') or '/']
+    while stack:
+        dirname = stack.pop()
+        yield dirname
+
+        try:
+            if scandir is not None:
+                subdirs = [entry.path for entry in scandir(dirname) if entry.is_dir(follow_symlinks=False)]
+            else:
+                subdirs = []
+                for name in os.listdir(dirname):
+                    path = os.path.join(dirname, name)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        subdirs.append(path)
+        except OSError as e:
+            synclogger.error("Listing dir failed: path=%s, error=%s." % (dirname, e))
+            continue
+
+        if exclude is not None:
+            subdirs = [path for path in subdirs if not exclude(path)]
+
+        subdirs.sort(reverse=True)
+        stack.extend(subdirs)
+
+def max_user_watches():
+    """读取系统允许每个用户监视的最大数量，读取失败返回None"""
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as fp:
+            return int(fp.read().strip())
+    except (IOError, ValueError):
+        return None
+
+def add_watches(root):
+    """把root下的所有目录加入监视，每个目录只调用一次add_watch"""
+    started = time.time()
+    limit = max_user_watches()
+    warned = False
+    count = 0
+    failed = 0
+
+    synclogger.info("Adding dirs into watch list: path=%s, max_user_watches=%s." % (root, limit))
+
+    for dirname in walk_dirs(root, UploadFtp.exclude_dir):
+        # 启动过程中收到了SIGTERM
+        if Daemon.stopping:
+            synclogger.info("Stopped adding dirs into watch list: path=%s, count=%d." % (root, count))
+            return count
+
+        synclogger.debug("Add new dir into watch list: %s." % (dirname))
+
+        result = wm.add_watch(dirname, mask, rec=False)
+        if result.get(dirname, -1) < 0:
+            failed += 1
+            # 遍历之后被删除或者重命名的目录，重新扫描其上级目录
+            if not os.path.isdir(dirname) and dirname != root.rstrip('/'):
+                Rescanner.put(os.path.dirname(dirname), 'add_watch failed')
+            continue
+
+        count += 1
+        if count % STARTUP_PROGRESS_INTERVAL == 0:
+            synclogger.info("Adding dirs into watch list: count=%d, seconds=%.2f." % (count, time.time() - started))
+
+        if limit and not warned and count >= limit * 0.9:
+            warned = True
+            synclogger.warning("The number of watches is close to fs.inotify.max_user_watches: count=%d, limit=%d." % (count, limit))
+
+    synclogger.info("Added dirs into watch list: count=%d, failed=%d, seconds=%.2f." % (count, failed, time.time() - started))
+    if failed and limit and count + failed >= limit:
+        synclogger.error("Some dirs are NOT watched, please increase fs.inotify.max_user_watches: limit=%d." % (limit))
+
+    return count
+
+def walk_tree(root, exclude=None, failed=None):
+    """遍历root下的所有目录和文件（不包括root），返回(路径, 是否目录, stat)，目录先于其下的文件返回
+
+    exclude返回True的目录不会进入遍历。无法读取的目录（例如没有权限）加入failed列表。
+    """
+    stack = [root.rstrip('/') or '/']
+    while stack:
+        dirname = stack.pop()
+
+        try:
+            if scandir is not None:
+                entries = [(entry.path, entry.is_dir(follow_symlinks=False), entry) for entry in scandir(dirname)]
+            else:
+                entries = []
+                for name in os.listdir(dirname):
+                    path = os.path.join(dirname, name)
+                    entries.append((path, os.path.isdir(path) and not os.path.islink(path), None))
+        except OSError as e:
+            synclogger.error("Listing dir failed: path=%s, error=%s." % (dirname, e))
+            if failed is not None:
+                failed.append(dirname)
+            continue
 
-            # 加入对新目录的监测
+        subdirs = []
+        for path, isdir, entry in sorted(entries):
             try:
-                wm.add_watch(event.pathname, mask, rec=True)
-                synclogger.debug("Add new dir to watch list: %s." % (event.pathname))
-            except Exception as e:
-                synclogger.error("Add new dir to watch list failed: path=%s, error=%s." % (event.pathname, e))
+                st = entry.stat(follow_symlinks=False) if entry is not None else os.lstat(path)
+            except OSError as e:
+                # 已经被删除的路径不需要记录
+                if failed is not None and e.errno != errno.ENOENT:
+                    failed.append(path)
+                continue
+
+            yield path, isdir, st
+            if isdir and (exclude is None or not exclude(path)):
+                subdirs.append(path)
+
+        subdirs.reverse()
+        stack.extend(subdirs)
+
+def reconcile(root, delete=False, targets=None):
+    """比较root下的文件和索引，把缺失或有变化的文件加入各目标服务器（默认为root所在监视路径的所有服务器）的上传队列
+
+    delete为True时，索引中有记录、本地已经不存在的路径从服务器上删除。
+    """
+    for target in targets or Transfer.route(root):
+        started = time.time()
+        synced = SyncIndex.entries(target.name, root)
+        counts = {'mkd': 0, 'upload': 0, 'delete': 0, 'skip': 0}
+        failed = []
+
+        for path, isdir, st in walk_tree(root, UploadFtp.exclude_dir, failed):
+            entry = synced.pop(path, None)
+
+            if UploadFtp.ignore(path, isdir):
+                continue
+
+            if isdir:
+                if entry is None or not entry[0]:
+                    target.put(SyncTask('mkd', path, isdir=True), wait=True)
+                    counts['mkd'] += 1
+                continue
+
+            if not stat.S_ISREG(st.st_mode) or UploadFtp.oversize(path, st.st_size):
+                # 只同步普通文件
+                continue
+
+            if entry is not None and not entry[0] and entry[1] == st.st_size:
+                if entry[2] == st.st_mtime:
+                    counts['skip'] += 1
+                    continue
+
+                # 只有修改时间变化时，比较文件内容
+                if (INDEX_HASH or DEDUPE) and entry[3] and HashCache.get(path) == entry[3]:
+                    SyncIndex.record(target.name, path, st.st_size, st.st_mtime, hash=entry[3])
+                    counts['skip'] += 1
+                    continue
+
+            task = SyncTask('upload', path)
+            task.priority, task.klass = Priority.classify(task, st.st_size)
+            target.put(task, wait=True)
+            counts['upload'] += 1
+
+        # 索引中有记录、本地已经不存在的路径，从下往上删除，无法读取的目录下的路径不知道是否存在，不删除
+        if delete:
+            for path in sorted(synced, reverse=True):
+                if path == root.rstrip('/'):
+                    continue
+                if [dirname for dirname in failed if path == dirname or path.startswith(dirname.rstrip('/') + '/')]:
+                    continue
+                # 被过滤规则排除的路径不再同步，也不从服务器上删除
+                if UploadFtp.ignore(path, synced[path][0]):
+                    continue
+                if synced[path][0]:
+                    target.put(SyncTask('rmd', path, isdir=True), wait=True)
+                else:
+                    target.put(SyncTask('delete', path), wait=True)
+                counts['delete'] += 1
+
+        synclogger.info("Reconciled with index: target=%s, path=%s, mkd=%d, upload=%d, delete=%d, unchanged=%d, seconds=%.2f." %
+                        (target.name, root, counts['mkd'], counts['upload'], counts['delete'], counts['skip'], time.time() - started))
+
+def reconcile_roots(delete=False, targets=None):
+    """比较所有的监视路径，targets不为空时只同步到其中的目标服务器"""
+    for root in WatchRoots.all():
+        routed = Transfer.route(root.path)
+        if targets is not None:
+            routed = [target for target in routed if target in targets]
+        if routed:
+            reconcile(root.path, delete, routed)
+
+class Daemon():
+    """守护进程的信号处理
 
+    SIGTERM、SIGINT：停止监视，等待上传队列中的任务执行完成后退出，超时后没有完成的任务保存到重试队列；
+    SIGHUP：重新读取CONFIG_FILE，应用有变化的配置项，已经监视的目录不需要重新加入监视。
+    信号处理函数只设置标志，由主线程在事件循环中处理。
+    """
+
+    handler = None
+    stopping = False
+    reloading = False
+
+    # 修改后需要更新过滤规则、重新扫描监视路径的配置项
+    FILTER_SETTINGS = set(['WATCH_PATH', 'WATCH_ROOTS', 'FILTER_INCLUDE', 'FILTER_EXCLUDE', 'FILTER_PRUNE_DIRS', 'FILTER_MAX_SIZE', 'FILE_TYPES', 'FILE_EXTENSIONS'])
+
+    @staticmethod
+    def on_signal(signum, frame):
+        if signum == signal.SIGHUP:
+            Daemon.reloading = True
+        else:
+            Daemon.stopping = True
+
+    @staticmethod
+    def tick(notifier):
+        """事件循环每次处理完事件（或者超时）后调用，返回True时结束事件循环"""
+        Daemon.handler.expire_moves(notifier)
+        if Daemon.reloading:
+            Daemon.reloading = False
             try:
-                ftp.rename(UploadFtp.path(event.src_pathname), UploadFtp.path(event.pathname))
-                synclogger.info("Renamed dir in server: from=%s, to=%s." % (UploadFtp.path(event.src_pathname), UploadFtp.path(event.pathname)))
+                Daemon.reload()
             except Exception as e:
-                synclogger.error("Renamed dir failed in server: from=%s, to=%s, error=%s." % (UploadFtp.path(event.src_pathname), UploadFtp.path(event.pathname), e))
-        else:
-            synclogger.debug("Renamed file: from=%s, to=%s." % (event.src_pathname, event.pathname))
+                synclogger.error("Reloading config failed: path=%s, error=%s." % (CONFIG_FILE, e))
+        return Daemon.stopping
+
+    @staticmethod
+    def reload():
+        """重新读取CONFIG_FILE，应用有变化的配置项，配置文件中没有的配置项恢复为默认值"""
+        if not CONFIG_FILE or not os.path.isfile(CONFIG_FILE):
+            synclogger.error("Reloading config failed, the config file NOT exists: path=%s." % (CONFIG_FILE))
+            return
+
+        settings = dict(SETTINGS)
+        try:
+            settings.update(load_config(CONFIG_FILE))
+        except Exception as e:
+            synclogger.error("Reloading config failed: path=%s, error=%s." % (CONFIG_FILE, e))
+            return
+
+        changed = {}
+        for key, value in settings.items():
+            if globals()[key] == value:
+                continue
+            if key in RESTART_SETTINGS:
+                synclogger.warning("The setting can NOT be reloaded, restart the daemon to apply it: key=%s." % (key))
+                continue
+            changed[key] = value
+
+        if not changed:
+            synclogger.info("Reloaded config, nothing changed: path=%s." % (CONFIG_FILE))
+            return
+
+        # 新的配置有错误时恢复原来的配置
+        old = dict((key, globals()[key]) for key in changed)
+        old['UPLOAD_TARGETS'] = UPLOAD_TARGETS
+        old['WATCH_ROOT_CONFIGS'] = WATCH_ROOT_CONFIGS
+        globals().update(changed)
+        error = check_config()
+        if error is None:
             try:
-                ftp.rename(UploadFtp.path(event.src_pathname), UploadFtp.path(event.pathname))
-                synclogger.info("Renamed file in server: from=%s, to=%s." % (UploadFtp.path(event.src_pathname), UploadFtp.path(event.pathname)))
+                roots = WatchRoots.load(WATCH_ROOT_CONFIGS)
             except Exception as e:
-                synclogger.error("Renamed file failed in server: from=%s, to=%s, error=%s." % (UploadFtp.path(event.src_pathname), UploadFtp.path(event.pathname), e))
+                error = 'The filter settings are invalid: %s.' % (e)
+        if error is not None:
+            globals().update(old)
+            synclogger.error("Reloading config failed, keep the old settings: path=%s, error=%s" % (CONFIG_FILE, error))
+            return
+
+        synclogger.info("Reloaded config: path=%s, changed=%s." % (CONFIG_FILE, ', '.join(sorted(changed))))
+
+        # 目标服务器先更新，新的监视路径可能同步到新的目标服务器
+        added = []
+        if UPLOAD_TARGETS != old['UPLOAD_TARGETS']:
+            added = Transfer.reload()
+
+        if Daemon.FILTER_SETTINGS & set(changed):
+            WatchRoots.roots = roots
+            Daemon.unwatch()
+            # 把新需要同步的目录加入监视，并上传新需要同步的文件
+            for root in WatchRoots.all():
+                Rescanner.put(root.path, 'reload')
+        elif added:
+            worker = threading.Thread(target=reconcile_roots, args=(False, added), name='reconcile')
+            worker.daemon = True
+            worker.start()
+
+        # 限速和优先级对之后发送的数据和加入队列的任务生效
+        Transfer.limit.rate = TRANSFER_RATE_LIMIT
+        if 'TRANSFER_PRIORITY_CLASSES' in changed:
+            Priority.classes = Priority.load(TRANSFER_PRIORITY_CLASSES)
+
+        # 合并、重试功能可能由关闭变为开启
+        Coalescer.start()
+        RetrySpool.start()
+
+    @staticmethod
+    def unwatch():
+        """去掉所有监视路径以外、或者被新的过滤规则排除的目录的监视"""
+        removed = set()
+        wds = []
+        for path, wd in sorted((watch.path.rstrip('/') or '/', wd) for wd, watch in wm.watches.items()):
+            if path in WatchRoots.roots:
+                continue
+            if WatchRoots.lookup(path) is None or os.path.dirname(path) in removed or UploadFtp.exclude_dir(path):
+                removed.add(path)
+                wds.append(wd)
+
+        if wds:
+            wm.rm_watch(wds, quiet=True)
+            synclogger.info("Removed dirs from watch list: count=%d." % (len(wds)))
+
+    @staticmethod
+    def shutdown():
+        """事件循环结束后，等待上传队列中的任务执行完成，最多等待SHUTDOWN_TIMEOUT秒"""
+        started = time.time()
+        synclogger.info("Stopping daemon, waiting for transfers: timeout=%s." % (SHUTDOWN_TIMEOUT))
+
+        # 等待配对的移出事件和等待合并的操作，都加入上传队列
+        Daemon.handler.expire_moves(force=True)
+        Coalescer.drain()
+
+        deadline = started + SHUTDOWN_TIMEOUT
+        while time.time() < deadline and [target for target in Transfer.targets if target.queue.qsize() or target.queue.running]:
+            time.sleep(0.1)
+
+        # 没有完成的任务（包括正在执行的）保存到重试队列，下次启动后执行
+        unfinished = 0
+        for target in Transfer.targets:
+            queued = target.queue.drain()
+            tasks = list(target.queue.running) + queued
+            RetrySpool.persist(target.name, tasks)
+            for task in queued:
+                task.release()
+            unfinished += len(tasks)
+
+        if unfinished and SyncIndex.conn is None:
+            synclogger.error("No index file, unfinished tasks are lost: count=%d." % (unfinished))
+        synclogger.info("Stopped daemon: unfinished=%d, seconds=%.2f." % (unfinished, time.time() - started))
+
+        # 传输线程不会退出，直接结束进程，超时后仍在上传的文件会被中断（已经保存到重试队列）
+        logging.shutdown()
+        os._exit(0)
 
 def run():
     """执行程序"""
     handler = EventHandler()
-    notifier = pyinotify.Notifier(wm, handler)
+    # 设置超时（MOVE_PAIR_TIMEOUT，为0时为1秒），没有事件时也会定期检查移出事件是否超时、是否收到了信号
+    notifier = pyinotify.Notifier(wm, handler, timeout=int((MOVE_PAIR_TIMEOUT or 1) * 1000))
+
+    # 编译各监视路径的过滤规则
+    WatchRoots.roots = WatchRoots.load(WATCH_ROOT_CONFIGS)
+
+    # 启动后台传输线程
+    SyncIndex.open(INDEX_FILE)
+    Transfer.start()
+    Coalescer.start()
+    RetrySpool.start()
+    Rescanner.start()
+
+    # 启动运行指标接口
+    Metrics.collect('sync_queue_tasks', 'gauge', lambda: [({'target': t.name}, t.queue.qsize()) for t in Transfer.targets])
+    Metrics.collect('sync_running_tasks', 'gauge', lambda: [({'target': t.name}, len(t.queue.running)) for t in Transfer.targets])
+    Metrics.collect('sync_dropped_tasks_total', 'counter', lambda: [({'target': t.name}, t.queue.dropped) for t in Transfer.targets])
+    Metrics.collect('sync_remote_cache_hits_total', 'counter', lambda: [({'target': t.name}, t.cache.hits) for t in Transfer.targets])
+    Metrics.collect('sync_remote_cache_misses_total', 'counter', lambda: [({'target': t.name}, t.cache.misses) for t in Transfer.targets])
+    Metrics.collect('sync_retry_tasks', 'gauge', lambda: [({}, RetrySpool.count)])
+    Metrics.collect('sync_coalescing_paths', 'gauge', lambda: [({}, len(Coalescer.pending))])
+    Metrics.collect('sync_watches', 'gauge', lambda: [({}, len(wm.watches))])
+    Metrics.start(METRICS_LISTEN)
+
+    # 信号只能在主线程中处理，SIGINT由pyinotify结束事件循环
+    # 在遍历监视路径之前设置，遍历大量目录期间收到的SIGTERM、SIGHUP不会使用默认的处理方式
+    Daemon.handler = handler
+    if threading.current_thread().name == 'MainThread':
+        signal.signal(signal.SIGTERM, Daemon.on_signal)
+        signal.signal(signal.SIGHUP, Daemon.on_signal)
 
     # 遍历现有的子目录，加入监视
-    for dirname, dirnames, filenames in os.walk(WATCH_PATH):
-        synclogger.debug("Add new dir into watch list: %s." % (dirname))
-        wm.add_watch(dirname, mask, rec=True)
+    for root in WatchRoots.all():
+        if Daemon.stopping:
+            break
+        add_watches(root.path)
 
-    notifier.loop()
+    # 上传守护进程停止期间变化的文件
+    if RECONCILE_ON_START and SyncIndex.conn is not None and not Daemon.stopping:
+        worker = threading.Thread(target=reconcile_roots, args=(RECONCILE_DELETE,), name='reconcile')
+        worker.daemon = True
+        worker.start()
+
+    if not Daemon.stopping:
+        notifier.loop(callback=Daemon.tick)
+    Daemon.shutdown()
 
 def daemon_start():
     """启动服务"""
@@ -536,12 +4166,28 @@ def daemon_start():
     # start the daemon main loop
     run()
 
+def daemon_running(pid):
+    """进程是否还在运行"""
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError as e:
+        return e.errno == errno.EPERM
+
 def daemon_stop():
-    """停止服务"""
+    """停止服务：发送SIGTERM，等待守护进程执行完上传队列中的任务后退出，超时后发送SIGKILL"""
     if os.path.exists(PID_FILE):
         pid = open(PID_FILE, 'r').read()
         try:
-            os.kill(int(pid), signal.SIGKILL)
+            os.kill(int(pid), signal.SIGTERM)
+            # 守护进程最多等待SHUTDOWN_TIMEOUT秒，再留出保存没有完成的任务的时间
+            deadline = time.time() + SHUTDOWN_TIMEOUT + 10
+            while daemon_running(int(pid)) and time.time() < deadline:
+                time.sleep(0.2)
+
+            if daemon_running(int(pid)):
+                os.kill(int(pid), signal.SIGKILL)
+                synclogger.warning("Daemon PID %s NOT stopped in time, killed." % pid)
             print >>sys.stderr, "Stop daemon PID %s success." % pid
             synclogger.info("Stop daemon PID %s success." % pid)
         except Exception as e:
@@ -553,13 +4199,28 @@ def daemon_stop():
         synclogger.error("Can't find PID file: path=%s." % PID_FILE)
         print >>sys.stderr, "Can't find PID file: path=%s." % PID_FILE
 
+def daemon_reload():
+    """重新读取配置文件"""
+    if os.path.exists(PID_FILE):
+        pid = open(PID_FILE, 'r').read()
+        try:
+            os.kill(int(pid), signal.SIGHUP)
+            print >>sys.stderr, "Reload daemon PID %s success." % pid
+            synclogger.info("Reload daemon PID %s success." % pid)
+        except Exception as e:
+            synclogger.error("Reloading daemon PID %s failed: %s." % (pid, e))
+            print >>sys.stderr, "Reloading daemon PID %s failed: %s." % (pid, e)
+    else:
+        synclogger.error("Can't find PID file: path=%s." % PID_FILE)
+        print >>sys.stderr, "Can't find PID file: path=%s." % PID_FILE
+
 def usage():
     """使用帮助"""
     print "Help ..."
 
 def main(argv):
     try:
-        opts, args = getopt.getopt(argv, "", ["start", "stop"])
+        opts, args = getopt.getopt(argv, "", ["start", "stop", "reload"])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -570,6 +4231,8 @@ def main(argv):
             daemon_stop()
         elif opt == '--start':
             daemon_start()
+        elif opt == '--reload':
+            daemon_reload()
         else:
             usage()
 